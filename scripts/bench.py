@@ -4,8 +4,8 @@
 """
 SYNOPSIS
 
-    bench [-b,--base] [-h,--help] [-k,--rank] [-r,--ratio] [-s,--size]
-          [-t,--threshold]
+    bench [-b,--base] [-e,--engine] [-h,--help] [-i,--index] [-k,--rank]
+          [-r,--ratio] [-s,--size] [-t,--threshold]
 
 DESCRIPTION
 
@@ -15,6 +15,10 @@ DESCRIPTION
         Configure the size of the user base to influence the underlying SVD.
         Defaults to 2500.
 
+    -e str, --engine str
+        Configure the SVD engine, one of: full, sparse, randomized.
+        Defaults to full.
+
     -p float, --proximity float
         Configure the minimum proximity of the neighbors to consider.
         Defaults to 1.0.
@@ -22,6 +26,12 @@ DESCRIPTION
     -h, --help
         Show this message.
 
+    -i str, --index str
+        Configure the neighborhood index, one of: exact, lsh. The recall of
+        the configured neighborhoods against the reference scan is reported,
+        so for exact it doubles as a parity check of the vectorized scan.
+        Defaults to exact.
+
     -k int, --rank int
         Configure the rank of the matrix approximation. Defaults to 100.
 
@@ -68,7 +78,8 @@ def report(description, verbose):
         print '[%s] %s' % (datetime.datetime.now().ctime(), description)
 
 
-def main(base, proximity, rank, ratio, size, threshold, verbose):
+def main(base, engine, index, proximity, rank, ratio, size, threshold,
+         verbose):
     if verbose:
         print header('Report')
     else:
@@ -83,6 +94,8 @@ def main(base, proximity, rank, ratio, size, threshold, verbose):
     t0 = time.time()
     conf = {
         'zeit.recommend.svd.base': base,
+        'zeit.recommend.svd.engine': engine,
+        'zeit.recommend.svd.index': index,
         'zeit.recommend.svd.rank': rank,
         'zeit.recommend.elasticsearch.host': '217.13.68.236',
         'zeit.recommend.zonapi.host': '217.13.68.229'
@@ -99,7 +112,7 @@ def main(base, proximity, rank, ratio, size, threshold, verbose):
         ).items()
 
     report('Expand goal and prediction dicts to matrices.', verbose)
-    goal_matrix = np.array(list(rb.expand(g[1]) for g in goal))
+    goal_matrix = rb.expand_many(g[1] for g in goal).toarray()
 
     report('Omit observations from user base according to ratio.', verbose)
     test = goal[:]
@@ -109,49 +122,45 @@ def main(base, proximity, rank, ratio, size, threshold, verbose):
             test[i] = test[i][0], list(test[i][1])[:idx]
         except Exception, e:
             report(e.message, verbose)
+    test_matrix = rb.expand_many(t[1] for t in test)
 
     report('Generate numerical predictions for each item-user pair.', verbose)
-    prediction_matrix = np.zeros_like(goal_matrix)
     t0 = time.time()
-    for i in range(len(test)):
-        try:
-            vector = rb.expand(test[i][1])
-            prediction_matrix[i, :] = rb.predict(vector, neighbors=base / 10)
-        except Exception, e:
-            report(e.message, verbose)
+    prediction_matrix = rb.predict_many(test_matrix, neighbors=base / 10)
     predicting = (time.time() - t0) / len(test)
 
+    report('Compare indexed to exact neighborhoods.', verbose)
+    t0 = time.time()
+    exact = rb.neighbors_many(test_matrix, neighbors=base / 10, exact=True)
+    scanning = (time.time() - t0) / len(test)
+    t0 = time.time()
+    approximate = rb.neighbors_many(test_matrix, neighbors=base / 10)
+    probing = (time.time() - t0) / len(test)
+    hood_aggregate = 0.0
+    for e, a in zip(exact, approximate):
+        hood_aggregate += len(set(e).intersection(a)) / float(len(e) or 1)
+    hood_recall = hood_aggregate / len(test)
+
     report('Calculate mean absolute error.', verbose)
-    error_aggregate = 0.0
-    for i in range(goal_matrix.shape[0]):
-        for j in range(goal_matrix.shape[1]):
-            try:
-                diff = prediction_matrix[i, j] - goal_matrix[i, j]
-                error_aggregate += abs(diff)
-            except Exception, e:
-                report(e.message, verbose)
+    error_aggregate = np.nansum(np.abs(prediction_matrix - goal_matrix))
     mae = error_aggregate / np.multiply(*goal_matrix.shape)
 
     report('Generate recommendations for incomplete test dict.', verbose)
-    prediction = dict()
     t0 = time.time()
-    for user, paths in test:
-        try:
-            vector = rb.expand(paths)
-            prediction[user] = rb.recommend(vector, proximity=proximity)
-        except Exception, e:
-            report(e.message, verbose)
+    recommendations = rb.recommend_many(test_matrix, proximity=proximity)
+    prediction = dict(zip((t[0] for t in test), recommendations))
     recommending = (time.time() - t0) / len(test)
 
     report('Calculate inter-method consistency.', verbose)
     imc_aggregate = 0.0
     t0 = time.time()
+    cfbs = rb.recommend_many(goal_matrix, proximity=0.5, neighbors=100)
     for i in range(size):
         try:
-            user = list(goal[i][1])
-            cb = mb.recommend(user, top_n=100)
-            cfb = rb.recommend(rb.expand(user), proximity=0.5, neighbors=100)
-            imc_aggregate += (len(set(cb).intersection(cfb)) / float(100))
+            # The item index is keyed by paths, the model by path ids.
+            paths = filter(None, rb.dictionary.decode_many(goal[i][1]))
+            cb = rb.dictionary.encode_many(mb.recommend(paths, top_n=100))
+            imc_aggregate += (len(set(cb).intersection(cfbs[i])) / float(100))
         except Exception, e:
             report(e.message, verbose)
     validating = (time.time() - t0) / len(test)
@@ -194,6 +203,8 @@ def main(base, proximity, rank, ratio, size, threshold, verbose):
 
     options = (
         'Base:\t\t%s' % base,
+        'Engine:\t\t%s' % engine,
+        'Index:\t\t%s' % index,
         'Proximity:\t%s' % proximity,
         'Rank:\t\t%s' % rank,
         'Ratio:\t\t%s' % ratio,
@@ -204,6 +215,9 @@ def main(base, proximity, rank, ratio, size, threshold, verbose):
     averages = (
         'Recommending:\t%.8fs' % recommending,
         'Predicting:\t%.8fs' % predicting,
+        'Scanning:\t%.8fs' % scanning,
+        'Probing:\t%.8fs' % probing,
+        'Hood recall:\t%.16f' % hood_recall,
         'Initializing:\t%.8fs' % initializing,
         'Validating:\t%.8fs' % validating,
         'MAE:\t\t%.16f' % mae,
@@ -234,6 +248,12 @@ if __name__ == '__main__':
             help='size of original user base',
             type='int'
             )
+        parser.add_option(
+            '-e',
+            '--engine',
+            default='full',
+            help='svd engine of matrix approximation'
+            )
         parser.add_option(
             '-p',
             '--proximity',
@@ -241,6 +261,12 @@ if __name__ == '__main__':
             help='proximity of neighborhood',
             type='float'
             )
+        parser.add_option(
+            '-i',
+            '--index',
+            default='exact',
+            help='index of neighborhood search'
+            )
         parser.add_option(
             '-k',
             '--rank',
@@ -278,6 +304,8 @@ if __name__ == '__main__':
         (options, args) = parser.parse_args()
         main(
             options.base,
+            options.engine,
+            options.index,
             options.proximity,
             options.rank,
             options.ratio,
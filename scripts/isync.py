@@ -1,80 +1,309 @@
+#!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
 """
-    Copyright: (c) 2013 by Nicolas Drebenstedt.
-    License: BSD, see LICENSE for more details.
+SYNOPSIS
+
+    isync [-b,--backfill] [-c,--checkpoint] [-f,--from] [-h,--help]
+          [-i,--index] [-r,--rows] [-s,--slice] [-u,--until]
+          [-w,--workers]
+
+DESCRIPTION
+
+    Copy articles from the Solr index of zeit.de into the weekly item index
+    of Elasticsearch. By default, the archive is walked one document at a
+    time, newest first.
+
+    In backfill mode, the release date range is split into slices that a
+    pool of workers pages through and writes with the bulk API. Refreshing
+    the index is disabled while loading and set back to its previous
+    interval afterwards. Completed slices are recorded in a checkpoint
+    file, so an interrupted backfill resumes with the slices that are still
+    missing.
+
+    -b, --backfill
+        Run in backfill mode.
+
+    -c str, --checkpoint str
+        Configure the checkpoint file of completed slices. Defaults to
+        isync.checkpoint.
+
+    -f str, --from str
+        Configure the first release date of the backfill as YYYY-MM-DD.
+        Defaults to 1946-01-01.
+
+    -h, --help
+        Show this message.
+
+    -i str, --index str
+        Configure the target index. Defaults to the index of the current
+        week.
+
+    -r int, --rows int
+        Configure the number of documents per Solr page and bulk request.
+        Defaults to 500.
+
+    -s int, --slice int
+        Configure the number of days per slice. Defaults to 30.
+
+    -u str, --until str
+        Configure the release date to end the backfill before as
+        YYYY-MM-DD. Defaults to tomorrow.
+
+    -w int, --workers int
+        Configure the number of concurrent slices. Defaults to 4.
+
+AUTHOR
+
+    Nicolas Drebenstedt <nicolas.drebenstedt@zeit.de>
+
+LICENSE
+
+    This script is BSD licenced, see LICENSE file for more info.
+
+VERSION
+
+    0.2
 """
 
 from datetime import date
 from datetime import datetime
+from datetime import timedelta
+from elasticsearch import Elasticsearch
+from elasticsearch.client import IndicesClient
+from elasticsearch.exceptions import TransportError
+from multiprocessing.pool import ThreadPool
 from time import sleep
 from urllib import urlencode
 from urllib import urlopen
+# Import ahead of the worker threads, strptime is not thread safe in py2.
+import _strptime
 import json
-import re
+import optparse
+import os
+import sys
+import threading
+import time
+import traceback
 
-from elasticsearch.client import IndicesClient
-from elasticsearch import Elasticsearch
+script_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(script_path + '/../storm/src/py/resources')
+
+from paths import normalize
 
 es = Elasticsearch(hosts=[{'host': 'localhost', 'port': 9200}])
 url = 'http://217.13.68.229:8983/solr/select'
-index = '%s-%s' % date.today().isocalendar()[:2]
-match = re.compile('seite-[0-9]|komplettansicht').match
-start = 0
 
+body = {
+    'item': {
+        'properties': {
+            'path': {
+                'type': 'string',
+                'store': 'yes',
+                'index': 'not_analyzed'
+                },
+            'title': {'type': 'string'},
+            'body': {'type': 'string'},
+            'teaser': {'type': 'string'},
+            'timestamp': {'type': 'date'}
+            },
+        '_id': {'path': 'path'}
+        }
+    }
 
-def main():
-    global newest, start
 
-    params = dict(
-        wt='json',
-        q='*:*',
-        fl='href,release_date,title,body,teaser_text',
-        sort='release_date desc',
-        rows='1',
-        start=start
-        )
+def header(caption):
+    return ' %s '.ljust(20, '-').rjust(30, '-') % caption
 
-    start += 1
-    raw = urlopen(url, urlencode(params))
-    doc = json.loads(raw.read())['response']['docs'][0]
 
+def to_item(doc):
     args = doc['release_date'], '%Y-%m-%dT%H:%M:%SZ'
     ts = int(datetime.strptime(*args).strftime('%s000'))
-
-    path = doc['href'][18:].rstrip('/')
-    if match(path):
-        path = path.rsplit('/', 1)[0]
-
-    item = dict(
-        path=path,
+    return dict(
+        path=normalize(doc['href'][18:]),
         title=doc.get('title'),
         body=doc.get('body'),
         teaser=doc.get('teaser_text'),
         timestamp=ts
         )
 
-    print path, es.index(index, 'item', item).get('created', False)
 
+def sync(index):
+    start = 0
+    while 1:
+        params = dict(
+            wt='json',
+            q='*:*',
+            fl='href,release_date,title,body,teaser_text',
+            sort='release_date desc',
+            rows='1',
+            start=start
+            )
+        start += 1
+        try:
+            raw = urlopen(url, urlencode(params))
+            item = to_item(json.loads(raw.read())['response']['docs'][0])
+            print item['path'], \
+                es.index(index, 'item', item).get('created', False)
+        except KeyboardInterrupt:
+            raise SystemExit(0)
+        except:
+            continue
+        finally:
+            sleep(0.02)
+
+
+def slices(begin, end, days):
+    while begin < end:
+        yield begin, min(begin + timedelta(days=days), end)
+        begin += timedelta(days=days)
 
-if __name__ == '__main__':
-    body = {
-        'item': {
-            'properties': {
-                'path': {
-                    'type': 'string',
-                    'store': 'yes',
-                    'index': 'not_analyzed'
-                    },
-                'title': {'type': 'string'},
-                'body': {'type': 'string'},
-                'teaser': {'type': 'string'},
-                'timestamp': {'type': 'date'}
-                },
-            '_id': {'path': 'path'}
-            }
-        }
 
+class Backfill(object):
+    """Load the slices of a release date range with a pool of workers."""
+
+    def __init__(self, index, rows, checkpoint):
+        self.index = index
+        self.rows = rows
+        self.checkpoint = checkpoint
+        self.completed = set()
+        if os.path.exists(checkpoint):
+            self.completed = set(json.load(open(checkpoint)))
+        self.lock = threading.Lock()
+        self.docs = 0
+        self.errors = 0
+        self.started = time.time()
+
+    def key(self, slice_):
+        return '%s/%s' % tuple(d.isoformat() for d in slice_)
+
+    def save(self):
+        partial = self.checkpoint + '.partial'
+        json.dump(sorted(self.completed), open(partial, 'w'))
+        os.rename(partial, self.checkpoint)
+
+    def load(self, slice_):
+        """Index all documents released within `slice_`, return the number
+        of documents rejected by Elasticsearch."""
+        # Range queries are inclusive, so end one second before the slice.
+        last = datetime.combine(slice_[1], datetime.min.time()) - \
+            timedelta(seconds=1)
+        params = dict(
+            wt='json',
+            q='release_date:[%sT00:00:00Z TO %sZ]' % (slice_[0].isoformat(),
+                                                      last.isoformat()),
+            fl='href,release_date,title,body,teaser_text',
+            sort='release_date asc',
+            rows=self.rows
+            )
+        start = 0
+        total = 0
+        while True:
+            params['start'] = start
+            raw = urlopen(url, urlencode(params))
+            docs = json.loads(raw.read())['response']['docs']
+            if not docs:
+                break
+            start += len(docs)
+
+            actions = []
+            errors = 0
+            for doc in docs:
+                try:
+                    item = to_item(doc)
+                except (KeyError, ValueError):
+                    errors += 1
+                    continue
+                actions.append({'index': {'_id': item['path']}})
+                actions.append(item)
+            items = es.bulk(actions, index=self.index,
+                            doc_type='item')['items'] if actions else []
+            failed = sum(1 for i in items if 'error' in i.values()[0])
+            errors += failed
+
+            with self.lock:
+                self.docs += len(items) - failed
+                self.errors += errors
+            total += failed
+            if len(docs) < self.rows:
+                break
+        return total
+
+    def report(self, caption):
+        elapsed = time.time() - self.started
+        print '%-23s %10d docs %8.1f docs/s %6d errors' % (
+            caption, self.docs, self.docs / max(elapsed, 1e-6), self.errors)
+        sys.stdout.flush()
+
+    def run(self, begin, end, days, workers):
+        pending = [s for s in slices(begin, end, days)
+                   if self.key(s) not in self.completed]
+
+        def work(slice_):
+            try:
+                return slice_, self.load(slice_)
+            except (IOError, ValueError, TransportError), e:
+                with self.lock:
+                    self.errors += 1
+                return slice_, e
+
+        pool = ThreadPool(workers)
+        try:
+            for slice_, result in pool.imap_unordered(work, pending):
+                # Slices with rejected documents are retried next run.
+                if result == 0:
+                    self.completed.add(self.key(slice_))
+                    self.save()
+                    self.report(self.key(slice_))
+                elif isinstance(result, Exception):
+                    print '%-23s failed: %s' % (self.key(slice_), result)
+                else:
+                    self.report(self.key(slice_) + '!')
+        finally:
+            pool.terminate()
+        return len(pending)
+
+
+def backfill(index, begin, end, days, workers, rows, checkpoint):
+    ic = IndicesClient(es)
+    settings = ic.get_settings(index=index, flat_settings=True)
+    interval = settings[index]['settings'].get('index.refresh_interval',
+                                               '1s')
+    ic.put_settings(index=index, body={'index': {'refresh_interval': '-1'}})
+    loader = Backfill(index, rows, checkpoint)
+    skipped = len(loader.completed)
+    try:
+        pending = loader.run(begin, end, days, workers)
+    finally:
+        ic.put_settings(index=index,
+                        body={'index': {'refresh_interval': interval}})
+        ic.refresh(index=index)
+
+    options = (
+        'Index:\t\t%s' % index,
+        'Range:\t\t%s to %s' % (begin, end),
+        'Slice:\t\t%s days' % days,
+        'Workers:\t%s' % workers,
+        'Rows:\t\t%s' % rows
+        )
+
+    results = (
+        'Slices:\t\t%s resumed, %s run, %s left' % (
+            skipped, pending, pending + skipped - len(loader.completed)),
+        'Documents:\t%s' % loader.docs,
+        'Errors:\t\t%s' % loader.errors,
+        'Duration:\t%.1fs' % (time.time() - loader.started),
+        'Throughput:\t%.1f docs/s' % (
+            loader.docs / max(time.time() - loader.started, 1e-6))
+        )
+
+    print header('Options')
+    print '\n'.join(options)
+    print header('Results')
+    print '\n'.join(results)
+
+
+def main(index, backfill_, begin, end, days, workers, rows, checkpoint):
     ic = IndicesClient(es)
 
     if not ic.exists(index):
@@ -88,12 +317,91 @@ if __name__ == '__main__':
             body=body
             )
 
-    while 1:
-        try:
-            main()
-        except KeyboardInterrupt:
-            raise SystemExit(0)
-        except:
-            continue
-        finally:
-            sleep(0.02)
+    if backfill_:
+        parse = lambda d: datetime.strptime(d, '%Y-%m-%d').date()
+        backfill(index, parse(begin), parse(end), days, workers, rows,
+                 checkpoint)
+    else:
+        sync(index)
+
+
+if __name__ == '__main__':
+    try:
+        parser = optparse.OptionParser(
+            formatter=optparse.TitledHelpFormatter(),
+            usage=globals()['__doc__'],
+            version='0.2'
+            )
+        parser.add_option(
+            '-b',
+            '--backfill',
+            action='store_true',
+            default=False,
+            help='run in backfill mode'
+            )
+        parser.add_option(
+            '-c',
+            '--checkpoint',
+            default='isync.checkpoint',
+            help='checkpoint file of completed slices'
+            )
+        parser.add_option(
+            '-f',
+            '--from',
+            default='1946-01-01',
+            dest='begin',
+            help='first release date of backfill'
+            )
+        parser.add_option(
+            '-i',
+            '--index',
+            default='%s-%s' % date.today().isocalendar()[:2],
+            help='target index'
+            )
+        parser.add_option(
+            '-r',
+            '--rows',
+            default=500,
+            help='documents per page and bulk request',
+            type='int'
+            )
+        parser.add_option(
+            '-s',
+            '--slice',
+            default=30,
+            help='days per slice',
+            type='int'
+            )
+        parser.add_option(
+            '-u',
+            '--until',
+            default=(date.today() + timedelta(days=1)).isoformat(),
+            help='release date to end backfill before'
+            )
+        parser.add_option(
+            '-w',
+            '--workers',
+            default=4,
+            help='number of concurrent slices',
+            type='int'
+            )
+        (options, args) = parser.parse_args()
+        main(
+            options.index,
+            options.backfill,
+            options.begin,
+            options.until,
+            options.slice,
+            options.workers,
+            options.rows,
+            options.checkpoint
+            )
+    except SystemExit, e:
+        raise e
+    except UserWarning, e:
+        print str(e)
+        os._exit(1)
+    except Exception, e:
+        print str(e)
+        traceback.print_exc()
+        os._exit(1)
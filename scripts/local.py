@@ -0,0 +1,612 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+SYNOPSIS
+
+    local [-c,--components] [-d,--duration] [-h,--help] [-i,--interval]
+          [-l,--live] [-o,--option] [-p,--pending] [-r,--rate]
+          [-s,--serializer] [-t,--timeout] [-u,--users] [-v,--verbose]
+
+DESCRIPTION
+
+    Run the Python spouts and bolts of ../storm/src/py/resources without a
+    JVM. Every component is started as a multilang subprocess of this script,
+    which routes tuples along the streams of Recommender.java, tracks tuple
+    trees in place of Storm's acker and reports per-component throughput,
+    queue depth and end-to-end latency. Components configured with a tick
+    frequency in Recommender.java receive tick tuples at that frequency.
+
+    Unless --live is given, the rabbitmq spout is replaced by a synthetic
+    one that emits random page views of the paths in fountain.py and
+    connects all synthetic users to the recommending bolts.
+
+    -c str, --components str
+        Configure a comma separated list of components to run, tuples to all
+        other components are dropped. Defaults to
+        rabbitmq,user,recommendation,morelikethis,outlet.
+
+    -d int, --duration int
+        Configure how many seconds the topology runs. Defaults to 60.
+
+    -h, --help
+        Show this message.
+
+    -i int, --interval int
+        Configure the seconds between progress reports. Defaults to 10.
+
+    -l, --live
+        Consume page views from RabbitMQ instead of generating them.
+
+    -o key=value, --option key=value
+        Override a topology configuration value, may be repeated.
+
+    -p int, --pending int
+        Configure the maximum number of pending tuples per spout.
+        Defaults to 100.
+
+    -r float, --rate float
+        Configure the page views per second of the synthetic spout, 0 means
+        as fast as the pending limit allows. Defaults to 0.
+
+    -s str, --serializer str
+        Configure the multilang serializer of all components, one of: json,
+        msgpack. Defaults to the choice made in Recommender.java.
+
+    -t int, --timeout int
+        Configure the seconds after which pending tuples fail. Defaults to 30.
+
+    -u int, --users int
+        Configure the number of synthetic users. Defaults to 100.
+
+    -v, --verbose
+        Print the log messages of all components.
+
+AUTHOR
+
+    Nicolas Drebenstedt <nicolas.drebenstedt@zeit.de>
+
+LICENSE
+
+    This script is BSD licenced, see LICENSE file for more info.
+
+VERSION
+
+    0.1
+"""
+
+from collections import defaultdict
+import hashlib
+import itertools
+import json
+import optparse
+import os
+import Queue
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+resources = os.path.realpath(script_path + '/../storm/src/py/resources')
+sys.path.append(resources)
+
+from fountain import links
+from storm import Histogram
+from storm import JSONSerializer
+from storm import MsgpackSerializer
+
+# Component, script, serializer and subscribed streams as in Recommender.java
+TOPOLOGY = (
+    ('zonapi', 'zonapi.py', 'json', ()),
+    ('item', 'item.py', 'json', (('zonapi', 'default'),)),
+    ('rabbitmq', 'rabbitmq.py', 'json', ()),
+    ('user', 'user.py', 'msgpack', (('rabbitmq', 'default'),)),
+    ('recommendation', 'recommendation.py', 'msgpack',
+     (('outlet', 'control'), ('user', 'default'))),
+    ('morelikethis', 'morelikethis.py', 'msgpack',
+     (('outlet', 'control'), ('user', 'default'))),
+    ('outlet', 'outlet.py', 'msgpack',
+     (('morelikethis', 'default'), ('recommendation', 'default')))
+    )
+
+# Tick tuple frequency in seconds as in Recommender.java
+TICKS = {
+    'item': 1,
+    'user': 1
+    }
+
+CONF = {
+    'zeit.recommend.async.concurrency': 8,
+    'zeit.recommend.elasticsearch.host': '217.13.68.236',
+    'zeit.recommend.elasticsearch.port': 9200,
+    'zeit.recommend.metrics.interval': 60,
+    'zeit.recommend.rabbitmq.exchange': 'zr_spout',
+    'zeit.recommend.rabbitmq.host': '217.13.68.236',
+    'zeit.recommend.rabbitmq.key': 'logstash',
+    'zeit.recommend.rabbitmq.port': 5672,
+    'zeit.recommend.rabbitmq.throughput': 0.5,
+    'zeit.recommend.svd.base': 2000,
+    'zeit.recommend.svd.engine': 'sparse',
+    'zeit.recommend.svd.rank': 100,
+    'zeit.recommend.svd.rebuild': 3600,
+    'zeit.recommend.zonapi.checkpoint':
+        '/var/tmp/zeit.recommend/zonapi.checkpoint',
+    'zeit.recommend.zonapi.host': '217.13.68.229',
+    'zeit.recommend.zonapi.port': 8983
+    }
+
+SERIALIZERS = {
+    'json': JSONSerializer,
+    'msgpack': MsgpackSerializer
+    }
+
+
+def header(caption):
+    return ' %s '.ljust(20, '-').rjust(30, '-') % caption
+
+
+class Task(object):
+    """Multilang subprocess running one spout or bolt."""
+
+    def __init__(self, runner, id, name, script, serializer, spout):
+        self.runner = runner
+        self.id = id
+        self.name = name
+        self.script = script
+        self.serializer = SERIALIZERS[serializer]()
+        self.spout = spout
+        self.counts = defaultdict(int)
+        self.depth = 0
+        self.pending = 0
+        self.queue = Queue.Queue()
+        self.commands = Queue.Queue()
+        self.synced = threading.Event()
+        self.emitted = False
+
+    def start(self, conf, context, piddir):
+        self.process = subprocess.Popen(
+            [sys.executable, self.script],
+            bufsize=-1,
+            cwd=resources,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+            )
+        self.queue.put(dict(conf=conf, context=context, pidDir=piddir))
+        for target in (self.write, self.read) + \
+                ((self.drive,) if self.spout else ()):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.kill()
+
+    def send(self, msg):
+        self.queue.put(msg)
+        self.depth = max(self.depth, self.queue.qsize())
+
+    def write(self):
+        while True:
+            msgs = [self.queue.get()]
+            try:
+                while True:
+                    msgs.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            data = ''.join(self.serializer.frame(msg) for msg in msgs)
+            try:
+                self.process.stdin.write(data)
+                self.process.stdin.flush()
+            except IOError:
+                return
+
+    def read(self):
+        while True:
+            try:
+                msg = self.serializer.read(self.process.stdout)
+            except EOFError:
+                if self.runner.running:
+                    print '[%s] Process exited.' % self.name
+                return
+            self.runner.handle(self, msg)
+
+    def drive(self):
+        # Like ShellSpout, only one command is outstanding at a time.
+        while self.runner.running:
+            try:
+                msg = self.commands.get_nowait()
+            except Queue.Empty:
+                if self.pending >= self.runner.pending:
+                    time.sleep(0.001)
+                    continue
+                msg = {'command': 'next'}
+            self.emitted = False
+            self.synced.clear()
+            self.send(msg)
+            self.synced.wait()
+            if msg['command'] == 'next' and not self.emitted:
+                time.sleep(0.001)
+
+    def ack(self, id):
+        self.commands.put({'command': 'ack', 'id': id})
+
+    def fail(self, id):
+        self.commands.put({'command': 'fail', 'id': id})
+
+
+class Fountain(object):
+    """Synthetic stand-in for the rabbitmq spout."""
+
+    def __init__(self, runner, id, users, rate):
+        self.runner = runner
+        self.id = id
+        self.name = 'rabbitmq'
+        self.spout = True
+        self.counts = defaultdict(int)
+        self.depth = 0
+        self.pending = 0
+        self.queue = Queue.Queue()
+        self.users = [hashlib.md5(str(i)).hexdigest() for i in range(users)]
+        self.rate = rate
+        self.ids = itertools.count()
+
+    def start(self, conf, context, piddir):
+        thread = threading.Thread(target=self.drive)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        pass
+
+    def drive(self):
+        while self.runner.running:
+            if self.rate:
+                time.sleep(1.0 / self.rate)
+            elif self.pending >= self.runner.pending:
+                time.sleep(0.001)
+                continue
+            # Some paths in fountain.py are wrapped with indentation.
+            path = random.choice(links).replace(' ', '')
+            tup = [int(time.time() * 1000), path, random.choice(self.users)]
+            msg = {'command': 'emit', 'id': next(self.ids), 'tuple': tup,
+                   'need_task_ids': False}
+            self.runner.handle(self, msg)
+
+    def ack(self, id):
+        pass
+
+    def fail(self, id):
+        pass
+
+
+class Runner(object):
+    """Route tuples between tasks and track their trees like Storm's acker.
+
+    Every tuple a spout emits with a message id roots a tree. Tuples emitted
+    with anchors join the trees of their anchors, and a tree completes once
+    all of its tuples have been acked.
+    """
+
+    def __init__(self, pending, timeout, verbose):
+        self.tasks = {}
+        self.subscribers = defaultdict(list)
+        self.pending = pending
+        self.timeout = timeout
+        self.verbose = verbose
+        self.running = False
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.tuples = {}
+        self.trees = {}
+        self.latency = Histogram()
+        self.results = defaultdict(int)
+
+    def subscribe(self, name, stream, subscriber):
+        if subscriber in self.tasks:
+            self.subscribers[(name, stream)].append(self.tasks[subscriber])
+
+    def handle(self, task, msg):
+        command = msg.get('command')
+        if command == 'emit':
+            self.emit(task, msg)
+        elif command == 'ack':
+            self.ack(task, msg['id'])
+        elif command == 'fail':
+            self.fail(task, msg['id'])
+        elif command == 'sync':
+            task.synced.set()
+        elif command in ('log', 'error') and self.verbose:
+            print '[%s] %s' % (task.name, msg['msg'])
+
+    def emit(self, task, msg):
+        stream = msg.get('stream', 'default')
+        targets = self.subscribers[(task.name, stream)]
+        with self.lock:
+            task.counts['emitted'] += 1
+            task.emitted = True
+            roots = set()
+            if task.spout and msg.get('id') is not None:
+                root = next(self.ids)
+                self.trees[root] = [task, msg['id'], time.time(), 0]
+                task.pending += 1
+                roots.add(root)
+            elif not task.spout:
+                for anchor in msg.get('anchors', ()):
+                    roots.update(self.tuples.get(anchor, ()))
+                roots.intersection_update(self.trees)
+            for target in targets:
+                self.deliver(target, task.name, task.id, stream,
+                             msg['tuple'], roots)
+            for root in roots:
+                if not self.trees[root][3]:
+                    self.complete(root, True)
+        if msg.get('need_task_ids', True):
+            task.send([target.id for target in targets])
+
+    def inject(self, name, stream, tup):
+        with self.lock:
+            for target in self.subscribers[(name, stream)]:
+                self.deliver(target, name, 0, stream, tup, ())
+
+    def tick(self, name, freq):
+        # Tick tuples belong to no tree, acking them is a no-op.
+        with self.lock:
+            self.deliver(self.tasks[name], '__system', -1, '__tick', [freq],
+                         ())
+
+    def deliver(self, target, name, task, stream, tup, roots):
+        id = str(next(self.ids))
+        if roots:
+            self.tuples[id] = roots
+            for root in roots:
+                self.trees[root][3] += 1
+        target.counts['received'] += 1
+        target.send(dict(id=id, comp=name, stream=stream, task=task,
+                         tuple=tup))
+
+    def ack(self, task, id):
+        with self.lock:
+            task.counts['acked'] += 1
+            for root in self.tuples.pop(id, ()):
+                tree = self.trees.get(root)
+                if tree:
+                    tree[3] -= 1
+                    if not tree[3]:
+                        self.complete(root, True)
+
+    def fail(self, task, id):
+        with self.lock:
+            task.counts['failed'] += 1
+            for root in self.tuples.pop(id, ()):
+                if root in self.trees:
+                    self.complete(root, False)
+
+    def complete(self, root, success):
+        spout, id, started, count = self.trees.pop(root)
+        spout.pending -= 1
+        if success:
+            self.latency.add(time.time() - started)
+            self.results['completed'] += 1
+            spout.ack(id)
+        else:
+            self.results['failed'] += 1
+            spout.fail(id)
+
+    def expire(self, now):
+        with self.lock:
+            expired = [root for root, tree in self.trees.items()
+                       if now - tree[2] > self.timeout]
+            for root in expired:
+                self.complete(root, False)
+            self.results['timeouts'] += len(expired)
+            if expired:
+                self.tuples = dict(
+                    (id, roots) for id, roots in self.tuples.items()
+                    if not roots.isdisjoint(self.trees))
+
+    def report(self, elapsed, previous):
+        lines = []
+        for name, task in sorted(self.tasks.items()):
+            rates = ' '.join(
+                '%s=%.1f/s' % (key, (task.counts[key] -
+                                     previous[name].get(key, 0)) / elapsed)
+                for key in ('received', 'emitted', 'acked', 'failed'))
+            lines.append('%-16s%s queue=%d' % (name, rates,
+                                                task.queue.qsize()))
+            previous[name] = dict(task.counts)
+        return lines
+
+
+def main(components, duration, interval, live, options, pending, rate,
+         serializer, timeout, users, verbose):
+    conf = dict(CONF)
+    for option in options:
+        key, value = option.split('=', 1)
+        try:
+            conf[key] = json.loads(value)
+        except ValueError:
+            conf[key] = value
+
+    piddir = tempfile.mkdtemp()
+    runner = Runner(pending, timeout, verbose)
+    tasks = runner.tasks
+    for id, (name, script, default, inputs) in enumerate(TOPOLOGY, 1):
+        if name not in components:
+            continue
+        if name == 'rabbitmq' and not live:
+            tasks[name] = Fountain(runner, id, users, rate)
+        else:
+            tasks[name] = Task(runner, id, name, script,
+                               serializer or default, not inputs)
+    for name, script, default, inputs in TOPOLOGY:
+        for source, stream in inputs:
+            runner.subscribe(source, stream, name)
+    context = {'task->component': dict((str(t.id), n)
+                                       for n, t in tasks.items())}
+
+    runner.running = True
+    try:
+        for name, task in tasks.items():
+            task.start(conf, dict(context, taskid=task.id), piddir)
+        if not live and 'rabbitmq' in tasks:
+            for user in tasks['rabbitmq'].users:
+                runner.inject('outlet', 'control', ['connect', user])
+
+        previous = defaultdict(dict)
+        started = reported = time.time()
+        ticked = dict((name, started) for name in TICKS if name in tasks)
+        while time.time() - started < duration:
+            time.sleep(min(1.0, max(duration - time.time() + started, 0)))
+            now = time.time()
+            runner.expire(now)
+            for name, last in ticked.items():
+                if now - last >= TICKS[name]:
+                    runner.tick(name, TICKS[name])
+                    ticked[name] = now
+            if now - reported >= interval:
+                print header('%ds' % (now - started))
+                print '\n'.join(runner.report(now - reported, previous))
+                reported = now
+        elapsed = time.time() - started
+    finally:
+        runner.running = False
+        for task in tasks.values():
+            task.stop()
+        shutil.rmtree(piddir, ignore_errors=True)
+
+    summary = runner.latency.summary()
+    totals = (
+        'Duration:\t%.2fs' % elapsed,
+        'Completed:\t%d' % runner.results['completed'],
+        'Failed:\t\t%d' % runner.results['failed'],
+        'Timeouts:\t%d' % runner.results['timeouts'],
+        'Pending:\t%d' % len(runner.trees),
+        'Throughput:\t%.2f/s' % (runner.results['completed'] / elapsed),
+        'Latency p50:\t%.2fms' % summary['p50'],
+        'Latency p99:\t%.2fms' % summary['p99'],
+        'Latency max:\t%.2fms' % summary['max']
+        )
+
+    components = []
+    for name, task in sorted(tasks.items()):
+        components.append('%-16s%s max_queue=%d' % (name, ' '.join(
+            '%s=%.1f/s' % (key, task.counts[key] / elapsed)
+            for key in ('received', 'emitted', 'acked', 'failed')),
+            task.depth))
+
+    print header('Components')
+    print '\n'.join(components)
+    print header('Topology')
+    print '\n'.join(totals)
+
+
+if __name__ == '__main__':
+    try:
+        parser = optparse.OptionParser(
+            formatter=optparse.TitledHelpFormatter(),
+            usage=globals()['__doc__'],
+            version='0.1'
+            )
+        parser.add_option(
+            '-c',
+            '--components',
+            default='rabbitmq,user,recommendation,morelikethis,outlet',
+            help='comma separated components to run'
+            )
+        parser.add_option(
+            '-d',
+            '--duration',
+            default=60,
+            help='seconds to run the topology',
+            type='int'
+            )
+        parser.add_option(
+            '-i',
+            '--interval',
+            default=10,
+            help='seconds between progress reports',
+            type='int'
+            )
+        parser.add_option(
+            '-l',
+            '--live',
+            action='store_true',
+            default=False,
+            help='consume page views from rabbitmq'
+            )
+        parser.add_option(
+            '-o',
+            '--option',
+            action='append',
+            default=[],
+            help='override a configuration value'
+            )
+        parser.add_option(
+            '-p',
+            '--pending',
+            default=100,
+            help='maximum pending tuples per spout',
+            type='int'
+            )
+        parser.add_option(
+            '-r',
+            '--rate',
+            default=0.0,
+            help='page views per second of the synthetic spout',
+            type='float'
+            )
+        parser.add_option(
+            '-s',
+            '--serializer',
+            help='multilang serializer of all components'
+            )
+        parser.add_option(
+            '-t',
+            '--timeout',
+            default=30,
+            help='seconds until pending tuples fail',
+            type='int'
+            )
+        parser.add_option(
+            '-u',
+            '--users',
+            default=100,
+            help='number of synthetic users',
+            type='int'
+            )
+        parser.add_option(
+            '-v',
+            '--verbose',
+            action='store_true',
+            default=False,
+            help='print component logs'
+            )
+        (options, args) = parser.parse_args()
+        main(
+            options.components.split(','),
+            options.duration,
+            options.interval,
+            options.live,
+            options.option,
+            options.pending,
+            options.rate,
+            options.serializer,
+            options.timeout,
+            options.users,
+            options.verbose
+            )
+    except SystemExit, e:
+        raise e
+    except UserWarning, e:
+        print str(e)
+        os._exit(1)
+    except Exception, e:
+        print str(e)
+        traceback.print_exc()
+        os._exit(1)
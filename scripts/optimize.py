@@ -60,36 +60,31 @@ def predict(params):
         rb.generate_seed(size=1000, threshold=0.25)
         ).items()
 
-    goal_matrix = np.array(list(rb.expand(g[1]) for g in goal))
+    goal_matrix = rb.expand_many(g[1] for g in goal).toarray()
 
     test = goal[:]
     for i in range(len(test)):
         test[i] = test[i][0], list(test[i][1])[:-int(len(test[i][1]) * 0.5)]
+    test_matrix = rb.expand_many(t[1] for t in test)
 
-    mae_aggr = 0.0
-    prediction_matrix = np.zeros_like(goal_matrix)
-    for i in range(len(test)):
-        vector = rb.expand(test[i][1])
-        prediction_matrix[i, :] = rb.predict(vector, neighbors=neighbors)
-    for i in range(goal_matrix.shape[0]):
-        for j in range(goal_matrix.shape[1]):
-            mae_aggr += abs(prediction_matrix[i, j] - goal_matrix[i, j])
+    prediction_matrix = rb.predict_many(test_matrix, neighbors=neighbors)
+    mae_aggr = np.nansum(np.abs(prediction_matrix - goal_matrix))
     mae = mae_aggr / np.multiply(*goal_matrix.shape)
 
     imc_aggr = 0.0
+    cfbs = rb.recommend_many(goal_matrix, proximity=0.5, neighbors=neighbors)
     for i in range(len(goal)):
-        user = list(goal[i][1])
-        cb = mb.recommend(user, top_n=100)
-        cfb = rb.recommend(rb.expand(user), proximity=0.5, neighbors=neighbors)
-        imc_aggr += (len(set(cb).intersection(cfb)) / float(neighbors))
+        # The item index is keyed by paths, the model by path ids.
+        paths = filter(None, rb.dictionary.decode_many(goal[i][1]))
+        cb = rb.dictionary.encode_many(mb.recommend(paths, top_n=100))
+        imc_aggr += (len(set(cb).intersection(cfbs[i])) / float(neighbors))
     imc = imc_aggr / float(len(test))
 
     f1_aggr = 0.0
-    for user, paths in test:
-        vector = rb.expand(paths)
-        docs = rb.recommend(vector, proximity=0.5, neighbors=neighbors)
-        intersection = float(len(set(rb.cols).intersection(docs)))
-        f1_aggr += intersection / (len(rb.cols) + len(docs))
+    docs = rb.recommend_many(test_matrix, proximity=0.5, neighbors=neighbors)
+    for i in range(len(test)):
+        intersection = float(len(set(rb.cols).intersection(docs[i])))
+        f1_aggr += intersection / (len(rb.cols) + len(docs[i]))
     f1 = f1_aggr / float(len(test))
 
     line = ['%.9f' % i for i in (neighbors, rank, mae, imc, f1)]
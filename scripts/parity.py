@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+SYNOPSIS
+
+    parity [-b,--base] [-d,--density] [-e,--engine] [-h,--help] [-i,--items]
+           [-k,--rank] [-n,--neighbors] [-q,--queries] [-s,--seed]
+           [-t,--top]
+
+DESCRIPTION
+
+    Check that the vectorized neighborhood search of the RecommendationBolt
+    class from ../storm/src/py/resources produces the same predictions and
+    recommendations as its original implementation, which is kept below as
+    the reference: one query at a time, a sorted neighborhood, a summed
+    weighted row of A per neighbor and a sorted dict of preferences. The
+    model is factorized from a synthetic seed, so no Elasticsearch host is
+    needed. Recommendation sets may only differ in items tied with the last
+    recommended one. Exits with status 1 on any other difference.
+
+    -b int, --base int
+        Configure the number of users in the synthetic seed. Defaults to
+        2000.
+
+    -d float, --density float
+        Configure the probability of a user having read an item. Defaults
+        to 0.05.
+
+    -e str, --engine str
+        Configure the SVD engine, one of: full, sparse, randomized.
+        Defaults to sparse.
+
+    -h, --help
+        Show this message.
+
+    -i int, --items int
+        Configure the number of items in the synthetic seed. Defaults to
+        500.
+
+    -k int, --rank int
+        Configure the rank of the matrix approximation. Defaults to 20.
+
+    -n int, --neighbors int
+        Configure the neighborhood size. Defaults to 100.
+
+    -q int, --queries int
+        Configure the number of query users. Defaults to 200.
+
+    -s int, --seed int
+        Configure the random seed. Defaults to 0.
+
+    -t int, --top int
+        Configure the number of recommendations per query. Defaults to 100.
+
+AUTHOR
+
+    Nicolas Drebenstedt <nicolas.drebenstedt@zeit.de>
+
+LICENSE
+
+    This script is BSD licenced, see LICENSE file for more info.
+
+VERSION
+
+    0.1
+"""
+
+import numpy as np
+import optparse
+import os
+import scipy.spatial
+import sys
+import time
+import traceback
+
+
+def header(caption):
+    return ' %s '.ljust(20, '-').rjust(30, '-') % caption
+
+
+def reference_predict(rb, vector, metric='cosine', neighbors=100):
+    query = np.array([np.dot(rb.S_k, np.dot(rb.V_t_k, vector))])
+    dist = scipy.spatial.distance.cdist(query, rb.U_k, metric)[0, :]
+    key = lambda x: 0 if np.isnan(x[1]) else x[1]
+    hood = sorted(zip(range(dist.shape[0]), dist), key=key)[-neighbors:]
+    aggregate = np.array([rb.A[i[0], :].toarray()[0] * i[1]
+                          for i in hood]).sum(0)
+    aggregate = np.nan_to_num(aggregate)
+    prefs = aggregate ** -1
+    prefs[np.isinf(prefs)] = 0.0
+    return np.where(vector.astype(bool), vector, prefs)
+
+
+def reference_recommend(rb, vector, top_n=100, proximity=1.0, **kwargs):
+    dist = reference_predict(rb, vector, **kwargs)
+    tups = [(i, dist[i]) for i in range(len(dist)) if dist[i] > proximity]
+    indicies = dict(sorted(tups, key=lambda x: x[1])[-top_n:]).keys()
+    return np.take(np.array(rb.cols), indicies)
+
+
+def seed(random, users, items, density):
+    for user in xrange(users):
+        observed = np.flatnonzero(random.rand(items) < density)
+        yield 'user-%d' % user, set(observed.tolist())
+
+
+def main(base, density, engine, items, rank, neighbors, queries, random_seed,
+         top_n):
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(script_path + '/../storm/src/py/resources')
+    from recommendation import RecommendationBolt
+    from recommendation import SVD_ENGINES
+
+    np.seterr(all='ignore')
+    random = np.random.RandomState(random_seed)
+    rb = RecommendationBolt()
+    rb.conf = {}
+    rows, cols, A = rb.build_seed_matrix(seed(random, base, items, density))
+    U_k, S, V_t_k = SVD_ENGINES[engine](A, rank)
+    rb.swap(rb.assemble(rows, cols, A, U_k, np.diagflat(S), V_t_k))
+
+    histories = [h for u, h in seed(random, queries, items, density)]
+    matrix = rb.expand_many(histories)
+    kwargs = dict(neighbors=neighbors)
+
+    t0 = time.time()
+    vectors = matrix.toarray()
+    reference = np.array([reference_predict(rb, v, **kwargs)
+                          for v in vectors])
+    recommended = [reference_recommend(rb, v, top_n=top_n, **kwargs)
+                   for v in vectors]
+    scanning = (time.time() - t0) / queries
+    t0 = time.time()
+    prediction = rb.predict_many(matrix, **kwargs)
+    recommendations = rb.recommend_many(matrix, top_n=top_n, **kwargs)
+    vectorized = (time.time() - t0) / queries
+
+    finite = np.isfinite(reference) & np.isfinite(prediction)
+    same = (np.isfinite(reference) == np.isfinite(prediction)).all()
+    difference = np.abs(reference[finite] - prediction[finite]).max()
+
+    # Items tied with the last reference recommendation may be swapped.
+    index = dict((c, i) for i, c in enumerate(rb.cols))
+    identical = ties = mismatches = 0
+    for prefs, expected, actual in zip(reference, recommended,
+                                       recommendations):
+        delta = set(expected).symmetric_difference(actual)
+        if not delta:
+            identical += 1
+            continue
+        boundary = min(prefs[index[c]] for c in expected) \
+            if len(expected) else None
+        if boundary is not None and all(
+                np.isclose(prefs[index[c]], boundary) for c in delta):
+            ties += 1
+        else:
+            mismatches += 1
+
+    options = (
+        'Base:\t\t%s' % base,
+        'Items:\t\t%s' % items,
+        'Density:\t%s' % density,
+        'Engine:\t\t%s' % engine,
+        'Rank:\t\t%s' % rank,
+        'Neighbors:\t%s' % neighbors,
+        'Queries:\t%s' % queries,
+        'Top:\t\t%s' % top_n,
+        'Seed:\t\t%s' % random_seed
+        )
+
+    results = (
+        'Max difference:\t%.3g' % difference,
+        'Same support:\t%s' % same,
+        'Identical:\t%s' % identical,
+        'Tied:\t\t%s' % ties,
+        'Mismatched:\t%s' % mismatches,
+        'Reference:\t%.6fs' % scanning,
+        'Vectorized:\t%.6fs' % vectorized
+        )
+
+    print header('Options')
+    print '\n'.join(options)
+    print header('Results')
+    print '\n'.join(results)
+
+    if mismatches or not same or difference > 1e-9:
+        raise UserWarning('Vectorized and reference results differ.')
+
+
+if __name__ == '__main__':
+    try:
+        parser = optparse.OptionParser(
+            formatter=optparse.TitledHelpFormatter(),
+            usage=globals()['__doc__'],
+            version='0.1'
+            )
+        parser.add_option(
+            '-b',
+            '--base',
+            default=2000,
+            help='number of seed users',
+            type='int'
+            )
+        parser.add_option(
+            '-d',
+            '--density',
+            default=0.05,
+            help='probability of a user having read an item',
+            type='float'
+            )
+        parser.add_option(
+            '-e',
+            '--engine',
+            default='sparse',
+            help='svd engine of matrix approximation'
+            )
+        parser.add_option(
+            '-i',
+            '--items',
+            default=500,
+            help='number of seed items',
+            type='int'
+            )
+        parser.add_option(
+            '-k',
+            '--rank',
+            default=20,
+            help='rank of matrix approximation',
+            type='int'
+            )
+        parser.add_option(
+            '-n',
+            '--neighbors',
+            default=100,
+            help='size of neighborhoods',
+            type='int'
+            )
+        parser.add_option(
+            '-q',
+            '--queries',
+            default=200,
+            help='number of query users',
+            type='int'
+            )
+        parser.add_option(
+            '-s',
+            '--seed',
+            default=0,
+            help='random seed',
+            type='int'
+            )
+        parser.add_option(
+            '-t',
+            '--top',
+            default=100,
+            help='number of recommendations per query',
+            type='int'
+            )
+        (options, args) = parser.parse_args()
+        main(
+            options.base,
+            options.density,
+            options.engine,
+            options.items,
+            options.rank,
+            options.neighbors,
+            options.queries,
+            options.seed,
+            options.top
+            )
+    except SystemExit, e:
+        raise e
+    except UserWarning, e:
+        print str(e)
+        os._exit(1)
+    except Exception, e:
+        print str(e)
+        traceback.print_exc()
+        os._exit(1)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+SYNOPSIS
+
+    protocol [-c,--components] [-h,--help] [-n,--number] [-s,--serializers]
+
+DESCRIPTION
+
+    Benchmark the multilang protocol of storm.py from
+    ../storm/src/py/resources. A minimal bolt or spout is driven over pipes
+    by a fake ShellBolt or ShellSpout parent, exchanging tuples shaped like
+    the page views, user histories and recommendations of the topology.
+    Reports tuples per second, bytes per tuple in both directions and CPU
+    time per tuple of the child process for every serializer, with and
+    without task id replies to emits.
+
+    -c str, --components str
+        Configure a comma separated list of components to drive, out of:
+        bolt, spout. Defaults to bolt,spout.
+
+    -h, --help
+        Show this message.
+
+    -n int, --number int
+        Configure the number of tuples per run. Defaults to 10000.
+
+    -s str, --serializers str
+        Configure a comma separated list of serializers, out of: json,
+        stdlib (json without ujson), msgpack. Defaults to
+        json,stdlib,msgpack.
+
+AUTHOR
+
+    Nicolas Drebenstedt <nicolas.drebenstedt@zeit.de>
+
+LICENSE
+
+    This script is BSD licenced, see LICENSE file for more info.
+
+VERSION
+
+    0.1
+"""
+
+import hashlib
+import optparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+resources = os.path.realpath(script_path + '/../storm/src/py/resources')
+sys.path.append(resources)
+
+from fountain import links
+from storm import JSONSerializer
+from storm import MsgpackSerializer
+
+BOLT = '''
+import storm
+class EchoBolt(storm.BasicBolt):
+    def process(self, tup):
+        storm.emit(tup.values, need_task_ids=%(need_task_ids)r)
+EchoBolt().run()
+'''
+
+SPOUT = '''
+import storm
+class EchoSpout(storm.Spout):
+    def nextTuple(self):
+        storm.emit(%(tuple)r, id=1, need_task_ids=%(need_task_ids)r)
+EchoSpout().run()
+'''
+
+# Hide ujson from storm.py to measure the stdlib json fallback.
+STDLIB = 'import sys\nsys.modules["ujson"] = None\n'
+
+
+def header(caption):
+    return ' %s '.ljust(20, '-').rjust(30, '-') % caption
+
+
+def shapes():
+    paths = [l.replace(' ', '') for l in links]
+    users = [hashlib.md5(str(i)).hexdigest() for i in range(100)]
+    ids = range(len(paths))
+    ts = int(time.time() * 1000)
+    return (
+        ('event', [ts, random.choice(paths), random.choice(users)]),
+        ('history', [random.choice(users), random.sample(ids, 20)]),
+        ('output', [random.choice(users), random.sample(ids, 10),
+                    random.sample(ids, 10)])
+        )
+
+
+class Counter(object):
+    """File wrapper counting the bytes read through it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, size):
+        data = self.stream.read(size)
+        self.count += len(data)
+        return data
+
+    def readline(self):
+        data = self.stream.readline()
+        self.count += len(data)
+        return data
+
+
+class Parent(object):
+    """Fake ShellBolt or ShellSpout parent of a multilang subprocess."""
+
+    def __init__(self, code, serializer):
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', code],
+            bufsize=-1,
+            cwd=resources,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+            )
+        self.stdout = Counter(self.process.stdout)
+        self.serializer = serializer
+        self.lock = threading.Lock()
+        self.written = 0
+
+    def send(self, msg):
+        data = self.serializer.frame(msg)
+        with self.lock:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+            self.written += len(data)
+
+    def receive(self):
+        return self.serializer.read(self.stdout)
+
+    def connect(self, piddir):
+        self.send(dict(conf={}, context={}, pidDir=piddir))
+        self.receive()
+        self.written = self.stdout.count = 0
+
+    def finish(self):
+        self.process.stdin.close()
+        rusage = os.wait4(self.process.pid, 0)[2]
+        return rusage.ru_utime + rusage.ru_stime
+
+
+def bolt(parent, tup, number, need_task_ids):
+    def feed():
+        for i in xrange(number):
+            parent.send(dict(id=str(i), comp='user', stream='default',
+                             task=1, tuple=tup))
+
+    thread = threading.Thread(target=feed)
+    thread.daemon = True
+    thread.start()
+    acked = 0
+    while acked < number:
+        msg = parent.receive()
+        if msg['command'] == 'ack':
+            acked += 1
+        elif msg['command'] == 'emit' and need_task_ids:
+            parent.send([2])
+    thread.join()
+
+
+def spout(parent, tup, number, need_task_ids):
+    for i in xrange(number):
+        parent.send({'command': 'next'})
+        while True:
+            msg = parent.receive()
+            if msg['command'] == 'sync':
+                break
+            if msg['command'] == 'emit' and need_task_ids:
+                parent.send([2])
+        parent.send({'command': 'ack', 'id': 1})
+        while parent.receive()['command'] != 'sync':
+            pass
+
+
+def run(component, serializer, tup, number, need_task_ids, piddir):
+    values = dict(tuple=tup, need_task_ids=need_task_ids)
+    code = (BOLT if component == 'bolt' else SPOUT) % values
+    if serializer == 'stdlib':
+        code = STDLIB + code
+    framing = MsgpackSerializer if serializer == 'msgpack' else JSONSerializer
+    parent = Parent(code, framing())
+    parent.connect(piddir)
+    t0 = time.time()
+    (bolt if component == 'bolt' else spout)(parent, tup, number,
+                                             need_task_ids)
+    elapsed = time.time() - t0
+    cpu = parent.finish()
+    return (number / elapsed, float(parent.written) / number,
+            float(parent.stdout.count) / number, 1e6 * cpu / number)
+
+
+def main(components, number, serializers):
+    piddir = tempfile.mkdtemp()
+    results = []
+    try:
+        for component in components:
+            for shape, tup in shapes():
+                if component == 'spout' and shape != 'event':
+                    continue
+                for serializer in serializers:
+                    for need_task_ids in (True, False):
+                        result = run(component, serializer, tup, number,
+                                     need_task_ids, piddir)
+                        results.append((component, shape, serializer,
+                                         'wait' if need_task_ids else 'skip')
+                                        + result)
+    finally:
+        shutil.rmtree(piddir, ignore_errors=True)
+
+    options = (
+        'Number:\t\t%s' % number,
+        'Components:\t%s' % ', '.join(components),
+        'Serializers:\t%s' % ', '.join(serializers)
+        )
+
+    lines = ['%-6s %-8s %-8s %-5s %10s %8s %8s %8s' % (
+        'comp', 'shape', 'codec', 'ids', 'tuples/s', 'B/in', 'B/out',
+        'us/cpu')]
+    for result in results:
+        lines.append('%-6s %-8s %-8s %-5s %10.1f %8.1f %8.1f %8.1f' % result)
+
+    print header('Options')
+    print '\n'.join(options)
+    print header('Results')
+    print '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    try:
+        parser = optparse.OptionParser(
+            formatter=optparse.TitledHelpFormatter(),
+            usage=globals()['__doc__'],
+            version='0.1'
+            )
+        parser.add_option(
+            '-c',
+            '--components',
+            default='bolt,spout',
+            help='comma separated components to drive'
+            )
+        parser.add_option(
+            '-n',
+            '--number',
+            default=10000,
+            help='number of tuples per run',
+            type='int'
+            )
+        parser.add_option(
+            '-s',
+            '--serializers',
+            default='json,stdlib,msgpack',
+            help='comma separated serializers to compare'
+            )
+        (options, args) = parser.parse_args()
+        main(
+            options.components.split(','),
+            options.number,
+            options.serializers.split(',')
+            )
+    except SystemExit, e:
+        raise e
+    except UserWarning, e:
+        print str(e)
+        os._exit(1)
+    except Exception, e:
+        print str(e)
+        traceback.print_exc()
+        os._exit(1)
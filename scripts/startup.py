@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+SYNOPSIS
+
+    startup [-b,--base] [-d,--directory] [-e,--engine] [-h,--help]
+            [-k,--rank] [-n,--repeat]
+
+DESCRIPTION
+
+    Compare the startup time of the RecommendationBolt class from
+    ../storm/src/py/resources when building its model from scratch and when
+    mapping it from an on-disk snapshot.
+
+    -b int, --base int
+        Configure the size of the user base to influence the underlying SVD.
+        Defaults to 2500.
+
+    -d str, --directory str
+        Configure the snapshot directory. Defaults to a temporary directory
+        that is removed afterwards.
+
+    -e str, --engine str
+        Configure the SVD engine, one of: full, sparse, randomized.
+        Defaults to sparse.
+
+    -h, --help
+        Show this message.
+
+    -k int, --rank int
+        Configure the rank of the matrix approximation. Defaults to 100.
+
+    -n int, --repeat int
+        Configure how many times the snapshot is loaded. Defaults to 10.
+
+AUTHOR
+
+    Nicolas Drebenstedt <nicolas.drebenstedt@zeit.de>
+
+LICENSE
+
+    This script is BSD licenced, see LICENSE file for more info.
+
+VERSION
+
+    0.1
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+
+def header(caption):
+    return ' %s '.ljust(20, '-').rjust(30, '-') % caption
+
+
+def main(base, directory, engine, rank, repeat):
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(script_path + '/../storm/src/py/resources')
+    from recommendation import RecommendationBolt
+
+    temporary = directory is None
+    directory = tempfile.mkdtemp() if temporary else directory
+    conf = {
+        'zeit.recommend.svd.base': base,
+        'zeit.recommend.svd.engine': engine,
+        'zeit.recommend.svd.rank': rank,
+        'zeit.recommend.elasticsearch.host': '217.13.68.236'
+        }
+
+    try:
+        rb = RecommendationBolt()
+        t0 = time.time()
+        rb.initialize(conf, None)
+        building = time.time() - t0
+
+        t0 = time.time()
+        path = rb.save(vars(rb), directory)
+        saving = time.time() - t0
+        size = sum(os.path.getsize(os.path.join(path, f))
+                   for f in os.listdir(path))
+
+        conf['zeit.recommend.svd.snapshot'] = directory
+        t0 = time.time()
+        for i in range(repeat):
+            RecommendationBolt().initialize(conf, None)
+        loading = (time.time() - t0) / repeat
+    finally:
+        if temporary:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    options = (
+        'Base:\t\t%s' % base,
+        'Engine:\t\t%s' % engine,
+        'Rank:\t\t%s' % rank,
+        'Users:\t\t%s' % len(rb.rows),
+        'Items:\t\t%s' % len(rb.cols),
+        'Snapshot:\t%d bytes' % size
+        )
+
+    timings = (
+        'Building:\t%.8fs' % building,
+        'Saving:\t\t%.8fs' % saving,
+        'Loading:\t%.8fs' % loading,
+        'Speedup:\t%.2fx' % (building / loading)
+        )
+
+    print header('Options')
+    print '\n'.join(options)
+    print header('Timings')
+    print '\n'.join(timings)
+
+
+if __name__ == '__main__':
+    try:
+        parser = optparse.OptionParser(
+            formatter=optparse.TitledHelpFormatter(),
+            usage=globals()['__doc__'],
+            version='0.1'
+            )
+        parser.add_option(
+            '-b',
+            '--base',
+            default=2500,
+            help='size of original user base',
+            type='int'
+            )
+        parser.add_option(
+            '-d',
+            '--directory',
+            help='directory of model snapshots'
+            )
+        parser.add_option(
+            '-e',
+            '--engine',
+            default='sparse',
+            help='svd engine of matrix approximation'
+            )
+        parser.add_option(
+            '-k',
+            '--rank',
+            default=100,
+            help='rank of matrix approximation',
+            type='int'
+            )
+        parser.add_option(
+            '-n',
+            '--repeat',
+            default=10,
+            help='number of snapshot loads',
+            type='int'
+            )
+        (options, args) = parser.parse_args()
+        main(
+            options.base,
+            options.directory,
+            options.engine,
+            options.rank,
+            options.repeat
+            )
+    except SystemExit, e:
+        raise e
+    except UserWarning, e:
+        print str(e)
+        os._exit(1)
+    except Exception, e:
+        print str(e)
+        traceback.print_exc()
+        os._exit(1)
@@ -0,0 +1,214 @@
+package zeit.recommend;
+
+import backtype.storm.Config;
+import backtype.storm.multilang.BoltMsg;
+import backtype.storm.multilang.ISerializer;
+import backtype.storm.multilang.NoOutputException;
+import backtype.storm.multilang.ShellMsg;
+import backtype.storm.multilang.SpoutMsg;
+import backtype.storm.task.TopologyContext;
+import backtype.storm.utils.Utils;
+import org.msgpack.MessagePack;
+import org.msgpack.packer.Packer;
+import org.msgpack.type.Value;
+
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.util.ArrayList;
+import java.util.Collection;
+import java.util.HashMap;
+import java.util.List;
+import java.util.Map;
+
+/**
+ * zeit.recommend.MsgpackSerializer
+ *
+ * Multilang serializer that frames msgpack messages with their length as a
+ * 4 byte big-endian integer, see MsgpackSerializer in storm.py.
+ *
+ * Copyright: (c) 2013 by Nicolas Drebenstedt.
+ * License: BSD, see LICENSE for more details.
+ */
+
+public class MsgpackSerializer implements ISerializer {
+
+  public static final String SERIALIZER = "zeit.recommend.multilang.serializer";
+
+  private transient DataOutputStream processIn;
+  private transient DataInputStream processOut;
+  private transient MessagePack msgpack;
+
+  /**
+   * Storm drops its own config keys from component configurations, so the
+   * serializer is chosen through a custom key and translated here.
+   */
+  public static Map select(Map conf) {
+    Map selected = new HashMap(conf);
+    if ("msgpack".equals(conf.get(SERIALIZER))) {
+      selected.put(Config.TOPOLOGY_MULTILANG_SERIALIZER,
+          MsgpackSerializer.class.getName());
+    }
+    return selected;
+  }
+
+  @Override
+  public void initialize(OutputStream processIn, InputStream processOut) {
+    this.processIn = new DataOutputStream(new BufferedOutputStream(processIn));
+    this.processOut = new DataInputStream(new BufferedInputStream(processOut));
+    this.msgpack = new MessagePack();
+  }
+
+  @Override
+  public Number connect(Map conf, TopologyContext context)
+      throws IOException, NoOutputException {
+    Map<String, Object> ctx = new HashMap<String, Object>();
+    ctx.put("taskid", context.getThisTaskId());
+    ctx.put("task->component", context.getTaskToComponent());
+
+    Map<String, Object> setupInfo = new HashMap<String, Object>();
+    setupInfo.put("pidDir", context.getPIDDir());
+    setupInfo.put("conf", conf);
+    setupInfo.put("context", ctx);
+    writeMessage(setupInfo);
+
+    return (Number) ((Map) readMessage()).get("pid");
+  }
+
+  @Override
+  public ShellMsg readShellMsg() throws IOException, NoOutputException {
+    Map msg = (Map) readMessage();
+    ShellMsg shellMsg = new ShellMsg();
+    shellMsg.setCommand((String) msg.get("command"));
+    shellMsg.setId(msg.get("id"));
+    shellMsg.setMsg((String) msg.get("msg"));
+
+    String stream = (String) msg.get("stream");
+    shellMsg.setStream(stream == null ? Utils.DEFAULT_STREAM_ID : stream);
+
+    Object task = msg.get("task");
+    shellMsg.setTask(task == null ? 0 : ((Number) task).longValue());
+
+    Object needTaskIds = msg.get("need_task_ids");
+    shellMsg.setNeedTaskIds(
+        needTaskIds == null || ((Boolean) needTaskIds).booleanValue());
+
+    shellMsg.setTuple((List<Object>) msg.get("tuple"));
+
+    Object anchors = msg.get("anchors");
+    if (anchors instanceof String) {
+      shellMsg.addAnchor((String) anchors);
+    } else if (anchors != null) {
+      for (Object anchor : (List) anchors) {
+        shellMsg.addAnchor((String) anchor);
+      }
+    }
+    return shellMsg;
+  }
+
+  @Override
+  public void writeBoltMsg(BoltMsg boltMsg) throws IOException {
+    Map<String, Object> msg = new HashMap<String, Object>();
+    msg.put("id", boltMsg.getId());
+    msg.put("comp", boltMsg.getComp());
+    msg.put("stream", boltMsg.getStream());
+    msg.put("task", boltMsg.getTask());
+    msg.put("tuple", boltMsg.getTuple());
+    writeMessage(msg);
+  }
+
+  @Override
+  public void writeSpoutMsg(SpoutMsg spoutMsg) throws IOException {
+    Map<String, Object> msg = new HashMap<String, Object>();
+    msg.put("command", spoutMsg.getCommand());
+    msg.put("id", spoutMsg.getId());
+    writeMessage(msg);
+  }
+
+  @Override
+  public void writeTaskIds(List<Integer> taskIds) throws IOException {
+    writeMessage(taskIds);
+  }
+
+  private Object readMessage() throws IOException, NoOutputException {
+    int length;
+    try {
+      length = processOut.readInt();
+    } catch (EOFException e) {
+      throw new NoOutputException("Pipe to subprocess seems to be broken!");
+    }
+    byte[] data = new byte[length];
+    processOut.readFully(data);
+    return unpack(msgpack.read(data));
+  }
+
+  private void writeMessage(Object msg) throws IOException {
+    ByteArrayOutputStream buffer = new ByteArrayOutputStream();
+    pack(msgpack.createPacker(buffer), msg);
+    processIn.writeInt(buffer.size());
+    buffer.writeTo(processIn);
+    processIn.flush();
+  }
+
+  private static void pack(Packer packer, Object obj) throws IOException {
+    if (obj == null) {
+      packer.writeNil();
+    } else if (obj instanceof String) {
+      packer.write((String) obj);
+    } else if (obj instanceof Boolean) {
+      packer.write(((Boolean) obj).booleanValue());
+    } else if (obj instanceof Double || obj instanceof Float) {
+      packer.write(((Number) obj).doubleValue());
+    } else if (obj instanceof Number) {
+      packer.write(((Number) obj).longValue());
+    } else if (obj instanceof Map) {
+      Map<?, ?> map = (Map<?, ?>) obj;
+      packer.writeMapBegin(map.size());
+      for (Map.Entry<?, ?> entry : map.entrySet()) {
+        packer.write(String.valueOf(entry.getKey()));
+        pack(packer, entry.getValue());
+      }
+      packer.writeMapEnd();
+    } else if (obj instanceof Collection) {
+      Collection<?> items = (Collection<?>) obj;
+      packer.writeArrayBegin(items.size());
+      for (Object item : items) {
+        pack(packer, item);
+      }
+      packer.writeArrayEnd();
+    } else {
+      packer.write(obj.toString());
+    }
+  }
+
+  private static Object unpack(Value value) {
+    if (value.isNilValue()) {
+      return null;
+    } else if (value.isBooleanValue()) {
+      return value.asBooleanValue().getBoolean();
+    } else if (value.isIntegerValue()) {
+      return value.asIntegerValue().getLong();
+    } else if (value.isFloatValue()) {
+      return value.asFloatValue().getDouble();
+    } else if (value.isRawValue()) {
+      return value.asRawValue().getString();
+    } else if (value.isArrayValue()) {
+      List<Object> list = new ArrayList<Object>();
+      for (Value item : value.asArrayValue()) {
+        list.add(unpack(item));
+      }
+      return list;
+    }
+    Map<Object, Object> map = new HashMap<Object, Object>();
+    for (Map.Entry<Value, Value> entry : value.asMapValue().entrySet()) {
+      map.put(unpack(entry.getKey()), unpack(entry.getValue()));
+    }
+    return map;
+  }
+}
@@ -1,6 +1,8 @@
 package zeit.recommend;
 
+import backtype.storm.task.OutputCollector;
 import backtype.storm.task.ShellBolt;
+import backtype.storm.task.TopologyContext;
 import backtype.storm.topology.IRichBolt;
 import backtype.storm.topology.OutputFieldsDeclarer;
 import backtype.storm.tuple.Fields;
@@ -26,6 +28,11 @@ public class PythonBolt extends ShellBolt implements IRichBolt {
     this.fields = new Fields(fields);
   }
 
+  @Override
+  public void prepare(Map cfg, TopologyContext ctx, OutputCollector oc) {
+    super.prepare(MsgpackSerializer.select(cfg), ctx, oc);
+  }
+
   @Override
   public void declareOutputFields(OutputFieldsDeclarer declarer) {
     declarer.declareStream("default", this.fields);
@@ -41,6 +41,6 @@ public class PythonSpout extends ShellSpout implements IRichSpout {
 
   @Override
   public void open(Map cfg, TopologyContext ctx, SpoutOutputCollector soc) {
-    super.open(cfg, ctx, soc);
+    super.open(MsgpackSerializer.select(cfg), ctx, soc);
   }
 }
\ No newline at end of file
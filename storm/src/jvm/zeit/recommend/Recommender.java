@@ -3,6 +3,7 @@ package zeit.recommend;
 import backtype.storm.Config;
 import backtype.storm.LocalCluster;
 import backtype.storm.topology.TopologyBuilder;
+import backtype.storm.tuple.Fields;
 
 /**
  * zeit.recommend.Recommender
@@ -20,13 +21,14 @@ public class Recommender {
 
     builder.setSpout(
         "zonapi",
-        new PythonSpout("zonapi.py", "path"),
+        new PythonSpout("zonapi.py", "path", "timestamp"),
         1);
 
      builder.setBolt(
         "item",
         new PythonBolt("item.py", "path"),
         1)
+        .addConfiguration(Config.TOPOLOGY_TICK_TUPLE_FREQ_SECS, 1)
         .shuffleGrouping("zonapi", "default");
 
     builder.setSpout(
@@ -38,12 +40,15 @@ public class Recommender {
         "user",
         new PythonBolt("user.py", "user", "paths"),
         1)
-        .shuffleGrouping("rabbitmq", "default");
+        .addConfiguration(MsgpackSerializer.SERIALIZER, "msgpack")
+        .addConfiguration(Config.TOPOLOGY_TICK_TUPLE_FREQ_SECS, 1)
+        .fieldsGrouping("rabbitmq", "default", new Fields("user"));
 
     builder.setBolt(
         "recommendation",
         new PythonBolt("recommendation.py", "user", "events", "recommendations"),
         1)
+        .addConfiguration(MsgpackSerializer.SERIALIZER, "msgpack")
         .shuffleGrouping("outlet", "control")
         .shuffleGrouping("user", "default");
 
@@ -51,6 +56,7 @@ public class Recommender {
         "morelikethis",
         new PythonBolt("morelikethis.py", "user", "events", "recommendations"),
         1)
+        .addConfiguration(MsgpackSerializer.SERIALIZER, "msgpack")
         .shuffleGrouping("outlet", "control")
         .shuffleGrouping("user", "default");
 
@@ -58,6 +64,7 @@ public class Recommender {
         "outlet",
         new PythonBolt("outlet.py"),
         1)
+        .addConfiguration(MsgpackSerializer.SERIALIZER, "msgpack")
         .shuffleGrouping("morelikethis", "default")
         .shuffleGrouping("recommendation", "default");
 
@@ -66,15 +73,22 @@ public class Recommender {
     conf.setMaxTaskParallelism(1);
 
     // TODO: Read config data from file.
+    conf.put(MsgpackSerializer.SERIALIZER, "json");
+    conf.put("zeit.recommend.async.concurrency", 8);
     conf.put("zeit.recommend.elasticsearch.host", "217.13.68.236");
     conf.put("zeit.recommend.elasticsearch.port", 9200);
+    conf.put("zeit.recommend.metrics.interval", 60);
     conf.put("zeit.recommend.rabbitmq.exchange", "zr_spout");
     conf.put("zeit.recommend.rabbitmq.host", "217.13.68.236");
     conf.put("zeit.recommend.rabbitmq.key", "logstash");
     conf.put("zeit.recommend.rabbitmq.port", 5672);
     conf.put("zeit.recommend.rabbitmq.throughput", 0.5);
     conf.put("zeit.recommend.svd.base", 2000);
+    conf.put("zeit.recommend.svd.engine", "sparse");
     conf.put("zeit.recommend.svd.rank", 100);
+    conf.put("zeit.recommend.svd.rebuild", 3600);
+    conf.put("zeit.recommend.zonapi.checkpoint",
+        "/var/tmp/zeit.recommend/zonapi.checkpoint");
     conf.put("zeit.recommend.zonapi.host", "217.13.68.229");
     conf.put("zeit.recommend.zonapi.port", 8983);
     conf.put("zeit.recommend.runtime", 420);
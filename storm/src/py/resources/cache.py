@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""
+    zeit.recommend.cache
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Size bounded in-process caches for the bolts.
+
+    Copyright: (c) 2013 by Nicolas Drebenstedt.
+    License: BSD, see LICENSE for more details.
+"""
+
+from collections import OrderedDict
+import hashlib
+import math
+import struct
+
+
+class LRUCache(object):
+    """Mapping of at most `capacity` keys that evicts the least recently
+    used one first.
+
+    Lookups through get() count as hits or misses in `metrics`, which the
+    storm.py instrumentation reports when a bolt exposes it.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.data = OrderedDict()
+        self.metrics = dict(hits=0, misses=0, evictions=0)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        while len(self.data) > self.capacity:
+            self.data.popitem(last=False)
+            self.metrics['evictions'] += 1
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.metrics['misses'] += 1
+            return default
+        self.data[key] = value
+        self.metrics['hits'] += 1
+        return value
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+
+class BloomFilter(object):
+    """Set of strings that answers membership with false positives at a
+    rate of about `error` once `capacity` keys have been added.
+
+    Keys are never stored, so a million paths fit into a few megabytes.
+    """
+
+    def __init__(self, capacity=1000000, error=0.001):
+        self.size = int(math.ceil(-capacity * math.log(error) /
+                                  math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size * math.log(2) / capacity)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        # Double hashing derives all positions from one digest.
+        a, b = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(a + i * b) % self.size for i in xrange(self.hashes)]
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & 1 << (p & 7)
+                   for p in self.positions(key))
+
+    def __len__(self):
+        return self.count
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
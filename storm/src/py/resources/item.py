@@ -10,23 +10,43 @@
     License: BSD, see LICENSE for more details.
 """
 
+from cache import BloomFilter
+from cache import LRUCache
+from collections import OrderedDict
 from datetime import date
 from datetime import datetime
 from elasticsearch import Elasticsearch
 from elasticsearch.client import IndicesClient
 from elasticsearch.exceptions import ConnectionError
+from elasticsearch.exceptions import TransportError
+from paths import normalize
+from paths import PathDictionary
+from storm import ack
 from storm import Bolt
 from storm import emit
-from storm import log
-from storm import ack
 from storm import fail
+from storm import log
 from urllib import urlencode
 from urllib import urlopen
 import json
-import re
+import time
 
 
 class ItemIndexBolt(Bolt):
+    """Fetch and index articles in micro-batches.
+
+    Incoming paths are collected until `batch` tuples are pending or
+    `interval` seconds have passed. The batch is then resolved with a
+    single Solr query of exact href terms and indexed with one bulk
+    request, and each tuple is acked or failed with the bulk result of its
+    item. Paths unknown to Solr are failed as well.
+
+    Articles are only indexed again if their release timestamp changed.
+    Recently indexed paths are kept in an LRU cache with their timestamp.
+    A Bloom filter warmed from the item index tells which of the other
+    paths need a lookup in Elasticsearch at all.
+    """
+
     def initialize(self, conf, context):
         host = conf.get('zeit.recommend.zonapi.host', 'localhost')
         port = conf.get('zeit.recommend.zonapi.port', 8983)
@@ -34,7 +54,20 @@ class ItemIndexBolt(Bolt):
         host = conf.get('zeit.recommend.elasticsearch.host', 'localhost')
         port = conf.get('zeit.recommend.elasticsearch.port', 9200)
         self.es = Elasticsearch(hosts=[{'host': host, 'port': port}])
-        self.match = re.compile('seite-[0-9]|komplettansicht').match
+        self.dictionary = PathDictionary(self.es)
+        self.batch = conf.get('zeit.recommend.item.batch', 100)
+        self.interval = conf.get('zeit.recommend.item.interval', 1.0)
+        self.pending = OrderedDict()
+        self.count = 0
+        self.flushed = time.time()
+        self.known = BloomFilter(
+            conf.get('zeit.recommend.item.capacity', 1000000),
+            conf.get('zeit.recommend.item.error', 0.001)
+            )
+        self.timestamps = LRUCache(
+            conf.get('zeit.recommend.item.cache', 10000))
+        self.metrics = self.timestamps.metrics
+        self.metrics['duplicates'] = 0
         self.index = '%s-%s' % date.today().isocalendar()[:2]
         ic = IndicesClient(self.es)
 
@@ -68,37 +101,159 @@ class ItemIndexBolt(Bolt):
                 body=body
                 )
 
-    def get_doc(self, path):
+        try:
+            self.warm()
+        except TransportError, e:
+            log('[ItemIndexBolt] TransportError, filter not warmed: %s' % e)
+
+    def warm(self):
+        results = self.es.search(index=self.index, doc_type='item',
+                                 size=1000, scroll='5m', fields='')
+        scroll_id = results['_scroll_id']
+        try:
+            while results['hits']['hits']:
+                for h in results['hits']['hits']:
+                    self.known.add(h['_id'])
+                results = self.es.scroll(scroll_id=scroll_id, scroll='5m')
+                scroll_id = results['_scroll_id']
+        finally:
+            self.es.clear_scroll(scroll_id=scroll_id)
+        log('[ItemIndexBolt] Warmed filter with %d items.' % len(self.known))
+
+    def unchanged(self, path, timestamp):
+        known = self.timestamps.get(path)
+        return known is not None and (timestamp is None or known >= timestamp)
+
+    def lookup(self, paths):
+        """Cache the indexed timestamps of those `paths` the filter knows."""
+        paths = [p for p in paths if p in self.known]
+        if not paths:
+            return
+        docs = self.es.mget(index=self.index, doc_type='item',
+                            body={'ids': paths},
+                            _source_include='timestamp')['docs']
+        for doc in docs:
+            if doc.get('found', doc.get('exists')):
+                self.timestamps[doc['_id']] = doc['_source']['timestamp']
+
+    def get_docs(self, paths):
+        # Hrefs are stored with and without trailing slash.
+        hrefs = ['http://www.zeit.de%s%s' % (p, s) for p in paths
+                 for s in ('', '/')]
         params = dict(
             wt='json',
-            q='href:*%s' % path,
-            fl='title,teaser_text,release_date,body'
+            q=' OR '.join('href:"%s"' % h for h in hrefs),
+            fl='href,title,teaser_text,release_date,body',
+            rows=len(hrefs)
             )
         raw = urlopen(self.url, urlencode(params))
-        data = raw.read()
-        doc = json.loads(data)['response']['docs'][0]
-        args = doc['release_date'], '%Y-%m-%dT%H:%M:%SZ'
-        ts = int(datetime.strptime(*args).strftime('%s000'))
-        return dict(
-            path=path,
-            title=doc.get('title'),
-            body=doc.get('body'),
-            teaser=doc.get('teaser_text'),
-            timestamp=ts
-            )
+        docs = {}
+        for doc in json.loads(raw.read())['response']['docs']:
+            path = normalize(doc['href'][18:])
+            args = doc['release_date'], '%Y-%m-%dT%H:%M:%SZ'
+            ts = int(datetime.strptime(*args).strftime('%s000'))
+            docs[path] = dict(
+                path=path,
+                title=doc.get('title'),
+                body=doc.get('body'),
+                teaser=doc.get('teaser_text'),
+                timestamp=ts
+                )
+        return docs
 
-    def process(self, tup):
-        path = tup.values[0].rstrip('/')
-        if self.match(path):
-            path = path.rsplit('/', 1)[0]
+    def flush(self):
+        self.flushed = time.time()
+        if not self.pending:
+            return
+        pending = self.pending.items()
+        self.pending = OrderedDict()
+        self.count = 0
+
+        try:
+            self.lookup(path for path, (ts, tuples) in pending
+                        if path not in self.timestamps)
+        except TransportError, e:
+            log('[ItemIndexBolt] TransportError, lookup failed: %s' % e)
+
+        changed = []
+        for path, (timestamp, tuples) in pending:
+            if self.unchanged(path, timestamp):
+                self.metrics['duplicates'] += len(tuples)
+                for tup in tuples:
+                    ack(tup)
+            else:
+                changed.append((path, tuples))
+        pending = changed
+        if not pending:
+            return
 
         try:
-            doc = self.get_doc(path)
-            if self.es.index(self.index, 'item', doc).get('ok', False):
-                emit([path])
-                ack(tup)
-        except:
-            fail(tup)
+            docs = self.get_docs([path for path, tuples in pending])
+        except (IOError, ValueError), e:
+            log('[ItemIndexBolt] Solr request failed: %s' % e)
+            for path, tuples in pending:
+                for tup in tuples:
+                    fail(tup)
+            return
+
+        found = [(p, tuples) for p, tuples in pending if p in docs]
+        for path, tuples in pending:
+            if path not in docs:
+                log('[ItemIndexBolt] Item not found: %s' % path)
+                for tup in tuples:
+                    fail(tup)
+        if not found:
+            return
+
+        body = []
+        for path, tuples in found:
+            body.append({'index': {'_index': self.index, '_type': 'item',
+                                   '_id': path}})
+            body.append(docs[path])
+
+        try:
+            items = self.es.bulk(body)['items']
+            ids = self.dictionary.encode_many(p for p, tuples in found)
+        except TransportError, e:
+            log('[ItemIndexBolt] TransportError, bulk failed: %s' % e)
+            items = ids = [{}] * len(found)
+
+        for (path, tuples), item, id in zip(found, items, ids):
+            result = item.values()[0] if item else {}
+            if '_version' in result and 'error' not in result:
+                if path not in self.known:
+                    self.known.add(path)
+                self.timestamps[path] = docs[path]['timestamp']
+                for tup in tuples:
+                    emit([id], anchors=[tup], need_task_ids=False)
+                    ack(tup)
+            else:
+                log('[ItemIndexBolt] Item could not be indexed: %s' % path)
+                for tup in tuples:
+                    fail(tup)
+
+    def process(self, tup):
+        if tup.stream == '__tick':
+            ack(tup)
+            if time.time() - self.flushed >= self.interval:
+                self.flush()
+            return
+
+        path = normalize(tup.values[0])
+        timestamp = tup.values[1] if len(tup.values) > 1 else None
+        if self.unchanged(path, timestamp):
+            self.metrics['duplicates'] += 1
+            ack(tup)
+            return
+
+        entry = self.pending.setdefault(path, [timestamp, []])
+        entry[0] = max(entry[0], timestamp)
+        entry[1].append(tup)
+        self.count += 1
+
+        if self.count >= self.batch or \
+                time.time() - self.flushed >= self.interval:
+            self.flush()
 
 
 if __name__ == '__main__':
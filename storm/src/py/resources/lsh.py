@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+    zeit.recommend.lsh
+    ~~~~~~~~~~~~~~~~~~
+
+    Random hyperplane locality sensitive hashing for cosine similarity.
+
+    Copyright: (c) 2013 by Nicolas Drebenstedt.
+    License: BSD, see LICENSE for more details.
+"""
+
+from collections import defaultdict
+import numpy as np
+
+
+class LSHIndex(object):
+    """Approximate cosine index over the rows of a dense matrix.
+
+    Every table hashes a row to the signs of its projections onto `bits`
+    random hyperplanes. Rows pointing in similar directions collide with
+    high probability, so a query only has to look at the rows sharing a
+    bucket with it in at least one table.
+    """
+
+    def __init__(self, dim, tables=10, bits=10, seed=0):
+        random = np.random.RandomState(seed)
+        self.planes = random.standard_normal((tables, bits, dim))
+        self.weights = 1 << np.arange(bits)
+        self.buckets = [defaultdict(list) for i in range(tables)]
+        self.size = 0
+
+    def hash(self, X):
+        signs = np.einsum('tbd,nd->ntb', self.planes, X) > 0
+        return signs.dot(self.weights)
+
+    def add(self, X):
+        X = np.atleast_2d(X)
+        ids = np.arange(self.size, self.size + X.shape[0])
+        codes = self.hash(X)
+        for t, buckets in enumerate(self.buckets):
+            order = np.argsort(codes[:, t], kind='mergesort')
+            keys, starts = np.unique(codes[order, t], return_index=True)
+            for key, group in zip(keys, np.split(ids[order], starts[1:])):
+                buckets[key].extend(group.tolist())
+        self.size += X.shape[0]
+
+    def query(self, q, n=100):
+        """Return the candidate rows for query vector `q`.
+
+        The exact buckets of all tables are probed first. If that yields
+        fewer than `n` candidates, buckets at hamming distance one from the
+        query codes are probed as well.
+        """
+        codes = self.hash(np.atleast_2d(q))[0]
+        candidates = set()
+        for buckets, code in zip(self.buckets, codes):
+            candidates.update(buckets.get(code, ()))
+        if len(candidates) < n:
+            for buckets, code in zip(self.buckets, codes):
+                for weight in self.weights:
+                    candidates.update(buckets.get(code ^ weight, ()))
+        return np.fromiter(candidates, dtype=int, count=len(candidates))
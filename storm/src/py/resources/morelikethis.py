@@ -11,15 +11,18 @@
 """
 
 import os
+import threading
 import time
 
 from elasticsearch import Elasticsearch
-from storm import Bolt
+from paths import PathDictionary
+from storm import AsyncBolt
 from storm import emit
 from storm import log
+from trending import TrendingCounter
 
 
-class MorelikethisBolt(Bolt):
+class MorelikethisBolt(AsyncBolt):
 
     connections = {}
 
@@ -27,9 +30,17 @@ class MorelikethisBolt(Bolt):
         host = conf.get('zeit.recommend.elasticsearch.host', 'localhost')
         port = conf.get('zeit.recommend.elasticsearch.port', 9200)
         self.es = Elasticsearch(hosts=[{'host': host, 'port': port}])
+        self.dictionary = PathDictionary(self.es)
         script_path = os.path.dirname(os.path.realpath(__file__))
         raw = open(script_path + '/stopwords.txt', 'r').read()
         self.stopwords = raw.decode('utf-8').split('\n')[3:]
+        self.history = conf.get('zeit.recommend.trending.history', 3)
+        self.lock = threading.Lock()
+        self.trending = TrendingCounter(
+            window=conf.get('zeit.recommend.trending.window', 3600),
+            buckets=conf.get('zeit.recommend.trending.buckets', 12),
+            size=conf.get('zeit.recommend.trending.size', 100)
+            )
 
     def recommend(self, paths, top_n=10):
         b = {
@@ -60,20 +71,31 @@ class MorelikethisBolt(Bolt):
     def process(self, tup):
         if tup.stream == 'control':
             action, user = tup.values
-            if action == 'connect':
-                self.connections[user] = int(time.time())
-            elif action == 'disconnect':
-                del self.connections[user]
+            with self.lock:
+                if action == 'connect':
+                    self.connections[user] = int(time.time())
+                elif action == 'disconnect':
+                    self.connections.pop(user, None)
 
         elif tup.stream == 'default':
             user, paths = tup.values
+            if paths:
+                with self.lock:
+                    self.trending.add(paths[-1])
             if user in self.connections:
                 log('[MorelikethisBolt] Incoming: %s' % user)
 
-                recommendations = self.recommend(paths)
+                if len(set(paths)) < self.history:
+                    with self.lock:
+                        recommendations = self.trending.top(10, set(paths))
+                else:
+                    known = filter(None, self.dictionary.decode_many(paths))
+                    recommendations = self.dictionary.encode_many(
+                        self.recommend(known))
                 paths = list(set(paths))[:10]
 
-                emit([user, paths, recommendations])
+                emit([user, paths, recommendations], anchors=[tup],
+                     need_task_ids=False)
 
 
 if __name__ == '__main__':
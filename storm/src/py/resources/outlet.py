@@ -10,9 +10,13 @@
     License: BSD, see LICENSE for more details.
 """
 
-from storm import Bolt
+from elasticsearch import Elasticsearch
+from paths import PathDictionary
+from storm import AsyncBolt
 from storm import emitBolt
+from storm import flush
 from storm import log
+from threading import Lock
 from threading import Thread
 from urllib import urlencode
 from urllib import urlopen
@@ -34,17 +38,24 @@ class OutletWebSocket(WebSocket):
             log('[OutletWebSocket] Client connected: %s' % uid)
             index = _server.manager.websockets.values().index(self)
             _clients[uid] = _server.manager.websockets.keys()[index]
-            emitBolt(['connect', uid], stream='control')
+            emitBolt(['connect', uid], stream='control',
+                     need_task_ids=False)
+            flush()
 
 
-class OutletBolt(Bolt):
+class OutletBolt(AsyncBolt):
     def initialize(self, conf, context):
         host = conf.get('zeit.recommend.zonapi.host', 'localhost')
         port = conf.get('zeit.recommend.zonapi.port', 9200)
         self.url = 'http://%s:%s/solr/select' % (host, port)
+        host = conf.get('zeit.recommend.elasticsearch.host', 'localhost')
+        port = conf.get('zeit.recommend.elasticsearch.port', 9200)
+        es = Elasticsearch(hosts=[{'host': host, 'port': port}])
+        self.dictionary = PathDictionary(es)
+        self.lock = Lock()
 
-    def resolve_paths(self, paths):
-        for path in paths:
+    def resolve_paths(self, ids):
+        for path in filter(None, self.dictionary.decode_many(ids)):
             params = dict(
                 wt='json',
                 q='href:*%s' % path,
@@ -73,7 +84,8 @@ class OutletBolt(Bolt):
 
         if user in _clients:
             ws = _server.manager.websockets[_clients[user]]
-            ws.send(json.dumps(message))
+            with self.lock:
+                ws.send(json.dumps(message))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""
+    zeit.recommend.paths
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Canonical article paths and their topology-wide integer ids.
+
+    Copyright: (c) 2013 by Nicolas Drebenstedt.
+    License: BSD, see LICENSE for more details.
+"""
+
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.exceptions import TransportError
+import re
+import threading
+
+match = re.compile('seite-[0-9]|komplettansicht').match
+
+
+def normalize(path):
+    """Strip trailing slashes and page segments off an article path."""
+    segments = path.rstrip('/').rsplit('/', 1)
+    return segments[0] if match(segments[-1]) else '/'.join(segments)
+
+
+class PathDictionary(object):
+    """Stable integer ids for paths, shared by all workers through an index.
+
+    Every path is stored twice in `index`: as a `path` document holding its
+    id and as an `id` document holding the path. New ids are taken from the
+    version counter of a single `sequence` document. When two workers
+    assign an id to the same path concurrently, only the first `path`
+    document is created and the other worker adopts its id.
+
+    Paths that cannot be assigned an id raise a TransportError, like any
+    other failed request to the index.
+    """
+
+    def __init__(self, es, index='paths'):
+        self.es = es
+        self.index = index
+        self.ids = {}
+        self.paths = {}
+        self.lock = threading.Lock()
+
+    def cache(self, path, id):
+        self.ids[path] = id
+        self.paths[id] = path
+
+    def fetch(self, doc_type, keys):
+        try:
+            docs = self.es.mget(index=self.index, doc_type=doc_type,
+                                body={'ids': map(unicode, keys)})['docs']
+        except NotFoundError:
+            return []
+        return [d for d in docs if d.get('found', d.get('exists'))]
+
+    def assign(self, paths):
+        body = []
+        for path in paths:
+            body.append({'index': {'_type': 'sequence', '_id': 'path'}})
+            body.append({})
+        items = [i.values()[0] for i in
+                 self.es.bulk(body, index=self.index)['items']]
+        if any('error' in i or '_version' not in i for i in items):
+            raise TransportError('N/A', 'Sequence not incremented', items)
+        ids = [i['_version'] for i in items]
+
+        body = []
+        for path, id in zip(paths, ids):
+            body.append({'index': {'_type': 'id', '_id': str(id)}})
+            body.append({'path': path})
+        for path, id in zip(paths, ids):
+            body.append({'create': {'_type': 'path', '_id': path}})
+            body.append({'id': id})
+        items = self.es.bulk(body, index=self.index)['items'][len(paths):]
+
+        for path, id, item in zip(paths, ids, items):
+            if 'error' not in item.values()[0]:
+                self.cache(path, id)
+        for doc in self.fetch('path', [p for p in paths if p not in self.ids]):
+            self.cache(doc['_id'], doc['_source']['id'])
+
+        missing = [p for p in paths if p not in self.ids]
+        if missing:
+            raise TransportError('N/A', 'Path ids not assigned', missing)
+
+    def encode_many(self, paths):
+        paths = list(paths)
+        with self.lock:
+            missing = set(p for p in paths if p not in self.ids)
+            if missing:
+                for doc in self.fetch('path', missing):
+                    self.cache(doc['_id'], doc['_source']['id'])
+                missing = sorted(p for p in missing if p not in self.ids)
+                if missing:
+                    self.assign(missing)
+            return [self.ids[p] for p in paths]
+
+    def encode(self, path):
+        return self.encode_many([path])[0]
+
+    def decode_many(self, ids):
+        """Return the paths of `ids`, None for ids never assigned."""
+        ids = list(ids)
+        with self.lock:
+            missing = set(i for i in ids if i not in self.paths)
+            if missing:
+                for doc in self.fetch('id', missing):
+                    self.cache(doc['_source']['path'], int(doc['_id']))
+            return [self.paths.get(i) for i in ids]
+
+    def decode(self, id):
+        return self.decode_many([id])[0]
@@ -52,7 +52,7 @@ class RabbitMQSpout(Spout):
             log('[RabbitMQSpout] Message %s failed for good.' % msg_id)
         else:
             self.buffer[msg_id] = (tup, retries + 1)
-            emit(tup, id=msg_id)
+            emit(tup, id=msg_id, need_task_ids=False)
 
     def nextTuple(self):
         raw = self.channel.basic_get(queue=self.queue, no_ack=True)[2]
@@ -66,7 +66,7 @@ class RabbitMQSpout(Spout):
             msg_id = str(uuid4())
             tup = [int(ts * 1000), parsed['path'], user]
             self.buffer[msg_id] = (tup, 0)
-            emit(tup, id=msg_id)
+            emit(tup, id=msg_id, need_task_ids=False)
 
 if __name__ == '__main__':
     RabbitMQSpout().run()
@@ -10,14 +10,119 @@
     License: BSD, see LICENSE for more details.
 """
 
+from array import array
 from elasticsearch import Elasticsearch
+from lsh import LSHIndex
+from paths import PathDictionary
+from storm import ack
 from storm import Bolt
 from storm import log
 from storm import emit
+from trending import TrendingCounter
+import itertools
+import json
 import numpy as np
+import os
 import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
 import scipy.spatial
+import shutil
+import threading
 import time
+import traceback
+
+
+def full_svd(A, k):
+    U, S, V_t = np.linalg.svd(A.toarray(), full_matrices=False)
+    return U[:, :k], S[:k], V_t[:k, :]
+
+
+def sparse_svd(A, k):
+    # ARPACK only converges for strictly fewer factors than min(A.shape).
+    k = min(k, min(A.shape) - 1)
+    U, S, V_t = scipy.sparse.linalg.svds(A, k=k)
+    order = np.argsort(S)[::-1]
+    return U[:, order], S[order], V_t[order, :]
+
+
+def randomized_svd(A, k, oversampling=10, iterations=2, seed=0):
+    # Halko, Martinsson, Tropp: sample the range of A, then decompose the
+    # small projection of A onto it.
+    l = min(k + oversampling, min(A.shape))
+    omega = np.random.RandomState(seed).standard_normal((A.shape[1], l))
+    Q = np.linalg.qr(A.dot(omega))[0]
+    for i in range(iterations):
+        Q = np.linalg.qr(A.T.dot(Q))[0]
+        Q = np.linalg.qr(A.dot(Q))[0]
+    U, S, V_t = np.linalg.svd(A.T.dot(Q).T, full_matrices=False)
+    return np.dot(Q, U)[:, :k], S[:k], V_t[:k, :]
+
+
+SNAPSHOT_FORMAT = 2
+
+SNAPSHOT_ARRAYS = ('U_k', 'S_k', 'V_t_k', 'U_n', 'null')
+
+SVD_ENGINES = {
+    'full': full_svd,
+    'sparse': sparse_svd,
+    'randomized': randomized_svd
+    }
+
+
+def normalize(X):
+    norms = np.sqrt(np.einsum('ij,ij->i', X, X))
+    return X / np.where(norms, norms, 1.0)[:, np.newaxis], norms == 0
+
+
+def cosine_distances(query, U_n, null):
+    # Zero rows have no cosine distance, cdist yields nan and the reference
+    # implementation counts those as zero.
+    query, empty = normalize(query)
+    dist = 1.0 - np.dot(query, U_n.T)
+    dist[empty, :] = 0.0
+    dist[:, null] = 0.0
+    return dist
+
+
+class GrowableArray(object):
+    """Array with amortized constant time appends along the first axis.
+
+    Capacity doubles whenever it is exhausted, so `array` is always a view
+    into a buffer that is at least half full.
+    """
+
+    def __init__(self, array):
+        self.buffer = array
+        self.size = array.shape[0]
+
+    @property
+    def array(self):
+        return self.buffer[:self.size]
+
+    def writable(self):
+        # Buffers mapped from a snapshot are read-only and shared with other
+        # processes, so take a private copy before modifying them in place.
+        if not self.buffer.flags.writeable:
+            self.buffer = np.array(self.buffer)
+        return self.array
+
+    def append(self, rows):
+        size = self.size + len(rows)
+        if size > self.buffer.shape[0]:
+            shape = (max(size, 2 * self.buffer.shape[0]),) + \
+                self.buffer.shape[1:]
+            buffer = np.empty(shape, dtype=self.buffer.dtype)
+            buffer[:self.size] = self.array
+            self.buffer = buffer
+        self.buffer[self.size:size] = rows
+        self.size = size
+
+
+def greatest(scores, n):
+    if n >= scores.shape[-1]:
+        return np.argsort(scores, axis=-1)
+    return np.argpartition(scores, -n, axis=-1)[..., -n:]
 
 
 class RecommendationBolt(Bolt):
@@ -25,32 +130,211 @@ class RecommendationBolt(Bolt):
     connections = {}
 
     def initialize(self, conf, context):
+        self.conf = conf
         self.host = conf.get('zeit.recommend.elasticsearch.host', 'localhost')
         self.port = conf.get('zeit.recommend.elasticsearch.port', 9200)
         self.folding = conf.get('zeit.recommend.svd.folding', False)
-        base = conf.get('zeit.recommend.svd.base', 18)
-        k = conf.get('zeit.recommend.svd.rank', 3)
+        self.updating = conf.get('zeit.recommend.svd.update', 'fold')
+        self.interval = conf.get('zeit.recommend.svd.rebuild', 0)
+        self.metrics = dict(rebuilds=0, failures=0, duration=0.0, interval=0.0)
+        self.pending = None
+        self.dictionary = PathDictionary(
+            Elasticsearch(hosts=[{'host': self.host, 'port': self.port}]))
+        self.trending = TrendingCounter(
+            window=conf.get('zeit.recommend.trending.window', 3600),
+            buckets=conf.get('zeit.recommend.trending.buckets', 12),
+            size=conf.get('zeit.recommend.trending.size', 100)
+            )
 
-        # TODO: Make from_ and threshold configurable.
-        seed = dict(self.generate_seed(size=base, threshold=0.3))
+        self.snapshot = conf.get('zeit.recommend.svd.snapshot')
 
-        self.cols = sorted(set([i for j in seed.values() for i in j]))
-        self.rows = sorted(seed.keys())
-        self.A = np.empty([len(self.rows), len(self.cols)])
+        t0 = time.time()
+        model = None
+        if self.snapshot and os.path.exists(
+                os.path.join(self.snapshot, 'CURRENT')):
+            try:
+                model = self.load(self.snapshot)
+            except (IOError, KeyError, ValueError), e:
+                log('[RecommendationBolt] Rebuilding snapshot: %s' % e)
+        if model is not None:
+            self.swap(model)
+        else:
+            model = self.build()
+            if self.snapshot:
+                self.save(model, self.snapshot)
+            self.swap(model)
+        self.metrics['duration'] = time.time() - t0
+        self.swapped = time.time()
 
-        for r in range(self.A.shape[0]):
-            paths = seed[self.rows[r]]
-            for c in range(self.A.shape[1]):
-                self.A[r, c] = float(self.cols[c] in paths)
+        if self.interval:
+            thread = threading.Thread(target=self.rebuild)
+            thread.daemon = True
+            thread.start()
 
-        self.U, self.S, self.V_t = np.linalg.svd(self.A, full_matrices=False)
+    def settings(self):
+        """Return the configuration a model is built from."""
+        return dict(
+            engine=self.conf.get('zeit.recommend.svd.engine', 'full'),
+            base=self.conf.get('zeit.recommend.svd.base', 18),
+            rank=self.conf.get('zeit.recommend.svd.rank', 3),
+            threshold=self.conf.get('zeit.recommend.svd.threshold', 0.3)
+            )
 
-        self.U_k = self.U[:, :k]
-        self.S_k = np.diagflat(self.S)[:k, :k]
-        self.V_t_k = self.V_t[:k, :]
+    def build(self):
+        """Factorize a fresh seed and return the resulting model state.
 
-    def generate_seed(self, from_=0, size=1000, threshold=0.0):
-        body = {
+        Only touches local state, so it is safe to call from the rebuild
+        thread while the current model keeps serving requests.
+        """
+        settings = self.settings()
+        chunk = self.conf.get('zeit.recommend.svd.chunk', 500)
+
+        seed = self.stream_seed(size=settings['base'],
+                                threshold=settings['threshold'], chunk=chunk)
+        rows, cols, A = self.build_seed_matrix(seed)
+
+        U_k, S, V_t_k = SVD_ENGINES[settings['engine']](A, settings['rank'])
+        model = self.assemble(rows, cols, A, U_k, np.diagflat(S), V_t_k)
+        model['built'] = time.time()
+        return model
+
+    def assemble(self, rows, cols, A, U_k, S_k, V_t_k, U_n=None, null=None):
+        if U_n is None:
+            U_n, null = normalize(U_k)
+
+        lsh = None
+        if self.conf.get('zeit.recommend.svd.index', 'exact') == 'lsh':
+            lsh = LSHIndex(
+                U_k.shape[1],
+                tables=self.conf.get('zeit.recommend.lsh.tables', 10),
+                bits=self.conf.get('zeit.recommend.lsh.bits', 10)
+                )
+            lsh.add(U_k)
+
+        # Path ids are dense, so columns are looked up by plain indexing.
+        lookup = np.full(max(cols) + 1 if cols else 0, -1, dtype=np.int64)
+        lookup[cols] = np.arange(len(cols))
+
+        return dict(
+            cols=cols,
+            rows=rows,
+            lookup=lookup,
+            users=dict((r, i) for i, r in enumerate(rows)),
+            labels=np.array(cols),
+            A=A,
+            U_k=U_k,
+            S_k=S_k,
+            V_t_k=V_t_k,
+            U_n=U_n,
+            null=null,
+            lsh=lsh,
+            rotation=None,
+            inverse=None,
+            stale=False,
+            buffers=dict(
+                U_k=GrowableArray(U_k),
+                U_n=GrowableArray(U_n),
+                null=GrowableArray(null),
+                data=GrowableArray(A.data),
+                indices=GrowableArray(A.indices),
+                indptr=GrowableArray(A.indptr)
+                )
+            )
+
+    def save(self, model, directory):
+        """Write `model` to a new snapshot version below `directory`.
+
+        Each version is a directory of .npy files plus a JSON manifest. It
+        is written under a temporary name and renamed into place, and the
+        CURRENT pointer is replaced atomically once the version is complete.
+        """
+        version = '%d' % (time.time() * 1000)
+        path = os.path.join(directory, version)
+        partial = path + '.partial'
+        os.makedirs(partial)
+        arrays = dict((name, model[name]) for name in SNAPSHOT_ARRAYS)
+        for name in ('data', 'indices', 'indptr'):
+            arrays['A.' + name] = getattr(model['A'], name)
+        for name, array in arrays.items():
+            np.save(os.path.join(partial, name + '.npy'), array)
+        manifest = dict(
+            format=SNAPSHOT_FORMAT,
+            shape=model['A'].shape,
+            rows=model['rows'],
+            cols=model['cols'],
+            settings=self.settings(),
+            built=model.get('built', time.time())
+            )
+        json.dump(manifest, open(os.path.join(partial, 'model.json'), 'w'))
+        os.rename(partial, path)
+
+        current = os.path.join(directory, 'CURRENT')
+        open(current + '.partial', 'w').write(version)
+        os.rename(current + '.partial', current)
+
+        retain = self.conf.get('zeit.recommend.svd.snapshots', 3)
+        versions = sorted(v for v in os.listdir(directory) if v.isdigit())
+        for old in versions[:-retain]:
+            shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+        return path
+
+    def load(self, directory):
+        """Map the current snapshot below `directory` into a model.
+
+        Arrays are opened with mmap_mode='r', so loading is independent of
+        the model size and processes sharing a host share the same pages.
+        Buffers are copied on their first modification.
+
+        Snapshots built with other settings, or more than
+        `zeit.recommend.svd.age` seconds ago, are rejected with ValueError.
+        """
+        version = open(os.path.join(directory, 'CURRENT')).read().strip()
+        path = os.path.join(directory, version)
+        manifest = json.load(open(os.path.join(path, 'model.json')))
+        if manifest['format'] != SNAPSHOT_FORMAT:
+            raise ValueError('Unsupported snapshot format: %s' %
+                             manifest['format'])
+        if manifest.get('settings') != self.settings():
+            raise ValueError('Snapshot settings differ: %s' %
+                             manifest.get('settings'))
+        age = time.time() - manifest.get('built', 0)
+        max_age = self.conf.get('zeit.recommend.svd.age', 86400)
+        if max_age and age > max_age:
+            raise ValueError('Snapshot is %.0fs old.' % age)
+        load = lambda name: np.load(os.path.join(path, name + '.npy'),
+                                    mmap_mode='r')
+        A = scipy.sparse.csr_matrix(
+            (load('A.data'), load('A.indices'), load('A.indptr')),
+            shape=tuple(manifest['shape'])
+            )
+        arrays = dict((name, load(name)) for name in SNAPSHOT_ARRAYS)
+        model = self.assemble(manifest['rows'], manifest['cols'], A,
+                              **arrays)
+        model['built'] = manifest['built']
+        return model
+
+    def swap(self, model):
+        # Runs between two tuples on the main thread, so process never sees
+        # a half replaced model.
+        self.__dict__.update(model)
+
+    def rebuild(self):
+        while True:
+            time.sleep(self.interval)
+            t0 = time.time()
+            try:
+                model = self.build()
+                if self.snapshot:
+                    self.save(model, self.snapshot)
+            except Exception, e:
+                self.metrics['failures'] += 1
+                log('[RecommendationBolt] Rebuild failed: %s' %
+                    traceback.format_exc(e))
+                continue
+            self.pending = model, time.time() - t0
+
+    def seed_query(self, threshold=0.0):
+        return {
             'query': {
                 'filtered': {
                     'query': {
@@ -66,58 +350,348 @@ class RecommendationBolt(Bolt):
                 }
             }
         }
+
+    def generate_seed(self, from_=0, size=1000, threshold=0.0):
+        es = Elasticsearch(hosts=[{'host': self.host, 'port': self.port}])
+        results = es.search(body=self.seed_query(threshold), from_=from_,
+                            size=size, doc_type='user',
+                            _source_include='events.path')
+        for user, ids in self.encode_hits(results['hits']['hits']):
+            yield user, ids
+
+    def stream_seed(self, size=1000, threshold=0.0, chunk=500):
+        """Scroll through up to `size` users, `chunk` hits per response.
+
+        Only the event paths are fetched, so neither the whole base nor
+        the full user documents ever have to fit into one response.
+        """
         es = Elasticsearch(hosts=[{'host': self.host, 'port': self.port}])
-        results = es.search(body=body, from_=from_, size=size, doc_type='user')
-        for h in results['hits']['hits']:
-            yield h['_id'], {e['path'] for e in h['_source']['events']}
+        results = es.search(body=self.seed_query(threshold), doc_type='user',
+                            size=min(chunk, size), scroll='5m',
+                            _source_include='events.path')
+        scroll_id = results['_scroll_id']
+        try:
+            while results['hits']['hits']:
+                hits = results['hits']['hits'][:size]
+                for user, ids in self.encode_hits(hits):
+                    yield user, ids
+                size -= len(results['hits']['hits'])
+                if size <= 0:
+                    break
+                results = es.scroll(scroll_id=scroll_id, scroll='5m')
+                scroll_id = results['_scroll_id']
+        finally:
+            es.clear_scroll(scroll_id=scroll_id)
+
+    def encode_hits(self, hits):
+        """Yield the user and path id set of each hit.
+
+        The paths of all hits are encoded in a single dictionary lookup.
+        """
+        histories = [[e['path'] for e in h['_source'].get('events', [])]
+                     for h in hits]
+        ids = iter(self.dictionary.encode_many(
+            itertools.chain.from_iterable(histories)))
+        for h, paths in zip(hits, histories):
+            yield h['_id'], {next(ids) for p in paths}
+
+    def build_seed_matrix(self, seed):
+        """Assemble a CSR matrix from a stream of (user, paths) pairs.
+
+        Columns are numbered in order of first appearance while streaming
+        and renumbered to sorted path id order at the end, so memory is only
+        needed for the matrix itself. Users streamed more than once keep
+        their first history.
+        """
+        rows = []
+        users = set()
+        columns = {}
+        indices = array('i')
+        indptr = array('i', [0])
+        for user, paths in seed:
+            if user in users:
+                continue
+            users.add(user)
+            rows.append(user)
+            indices.extend(columns.setdefault(p, len(columns)) for p in paths)
+            indptr.append(len(indices))
+
+        cols = sorted(columns)
+        order = np.empty(len(cols), dtype=np.int32)
+        order[[columns[c] for c in cols]] = np.arange(len(cols))
+        indices = order[np.frombuffer(indices, dtype=np.int32)]
+        indptr = np.frombuffer(indptr, dtype=np.int32)
+        data = np.ones(len(indices))
+        A = scipy.sparse.csr_matrix((data, indices, indptr),
+                                    shape=(len(rows), len(cols)))
+        A.sort_indices()
+        return rows, cols, A
+
+    def columns(self, paths):
+        ids = np.unique(np.fromiter(paths, dtype=np.int64))
+        ids = ids[(ids >= 0) & (ids < len(self.lookup))]
+        columns = self.lookup[ids]
+        return columns[columns >= 0]
+
+    def build_matrix(self, histories):
+        indptr = [0]
+        indices = []
+        for paths in histories:
+            indices.extend(self.columns(paths))
+            indptr.append(len(indices))
+        data = np.ones(len(indices))
+        shape = len(indptr) - 1, len(self.cols)
+        return scipy.sparse.csr_matrix((data, indices, indptr), shape=shape)
 
     def expand(self, paths):
         # TODO: AssertionError is caught nowhere!
         assert isinstance(paths, list) or isinstance(paths, set)
-        for i in paths:
-            assert isinstance(i, unicode)
-        return np.array([float(p in paths) for p in self.cols])
+        vector = np.zeros(len(self.cols))
+        vector[self.columns(paths)] = 1.0
+        return vector
+
+    def expand_many(self, histories):
+        return self.build_matrix(histories)
 
     def fold(self, user, vector):
-        projection = np.dot(self.S_k, np.dot(self.V_t_k, vector))
-        self.V_t_k = np.hstack((self.V_t_k, np.array([projection]).T))
+        """Fold the observations of `user` into the model.
+
+        The user is appended as a new row of A and U_k, so folded users are
+        available as neighbors right away. A returning user's previous row
+        is discarded. By default the row is projected onto the existing
+        factors; with `zeit.recommend.svd.update` set to 'brand', the
+        factorization itself is updated to include the new row.
+        """
+        if user in self.users:
+            self.discard(self.users[user])
+
+        if self.updating == 'brand':
+            u = self.brand_update(vector)
+        else:
+            S = np.diag(self.S_k)
+            u = np.dot(self.V_t_k, vector) / np.where(S, S, 1.0)
+
+        u_n, null = normalize(u[np.newaxis, :])
+        indices = np.flatnonzero(vector)
+        self.buffers['U_k'].append(u[np.newaxis, :])
+        self.buffers['U_n'].append(u_n)
+        self.buffers['null'].append(null)
+        self.buffers['data'].append(vector[indices])
+        self.buffers['indices'].append(indices)
+        self.buffers['indptr'].append([self.buffers['data'].size])
+        if self.lsh is not None:
+            self.lsh.add(u)
+
+        self.users[user] = len(self.rows)
         self.rows.append(user)
+        self.refresh()
+
+    def discard(self, row):
+        # Zero rows have no cosine distance and never carry any weight.
+        self.buffers['U_k'].writable()[row] = 0.0
+        self.buffers['U_n'].writable()[row] = 0.0
+        self.buffers['null'].writable()[row] = True
 
-    def predict(self, vector, metric='cosine', neighbors=100):
-        query = np.array([np.dot(self.S_k, np.dot(self.V_t_k, vector))])
-        dist = scipy.spatial.distance.cdist(query, self.U_k, metric)[0, :]
-        key = lambda x: 0 if np.isnan(x[1]) else x[1]
-        hood = sorted(zip(range(dist.shape[0]), dist), key=key)[-neighbors:]
-        aggregate = np.array([self.A[i[0], :] * i[1] for i in hood]).sum(0)
-        aggregate = np.nan_to_num(aggregate)
-        prefs = aggregate ** -1
-        prefs[np.isinf(prefs)] = 0.0
-        return np.where(vector.astype(bool), vector, prefs)
-
-    def recommend(self, vector, top_n=100, proximity=1.0, **kwargs):
-        dist = self.predict(vector, **kwargs)
-        tups = [(i, dist[i]) for i in range(len(dist)) if dist[i] > proximity]
-        indicies = dict(sorted(tups, key=lambda x: x[1])[-top_n:]).keys()
-        return np.take(np.array(self.cols), indicies)
+    def brand_update(self, vector):
+        """Update the rank-k SVD with one appended row.
+
+        See Brand (2006), Fast low-rank modifications of the thin singular
+        value decomposition. The rotation of the existing rows of U_k is
+        only accumulated in the small `rotation` matrix, so the stored rows
+        satisfy U_k = stored . rotation and an update costs nothing per
+        user. Returns the new row in the coordinates of the stored rows.
+        """
+        k = self.S_k.shape[0]
+        p = np.dot(self.V_t_k, vector)
+        r = vector - np.dot(p, self.V_t_k)
+        rho = np.linalg.norm(r)
+        K = np.zeros((k + 1, k + 1))
+        K[:k, :k] = self.S_k
+        K[k, :k] = p
+        K[k, k] = rho
+        U, S, V_t = np.linalg.svd(K)
+
+        q = r / rho if rho else r
+        self.V_t_k = np.dot(V_t[:k, :k], self.V_t_k) + np.outer(V_t[:k, k], q)
+        self.S_k = np.diagflat(S[:k])
+        if self.rotation is None:
+            self.rotation = U[:k, :k]
+        else:
+            self.rotation = np.dot(self.rotation, U[:k, :k])
+        self.inverse = np.linalg.pinv(self.rotation)
+        return np.dot(U[k, :k], self.inverse)
+
+    def materialize(self):
+        """Apply a pending rotation to U_k and its normalized rows.
+
+        Only runs ahead of a full scan. Without an LSH index, whose hashes
+        are taken from the stored rows, the rotation is applied to them for
+        good, which also keeps it from accumulating rounding errors.
+        """
+        if not self.stale:
+            return
+        U_k = np.dot(self.buffers['U_k'].array, self.rotation)
+        U_n, null = normalize(U_k)
+        null |= self.buffers['null'].array
+        if self.lsh is None:
+            self.buffers['U_k'].writable()[:] = U_k
+            self.buffers['U_n'].writable()[:] = U_n
+            self.buffers['null'].writable()[:] = null
+            self.rotation = self.inverse = None
+            self.refresh()
+        else:
+            self.U_k, self.U_n, self.null = U_k, U_n, null
+            self.stale = False
+
+    def candidates(self, rows):
+        """Return the normalized rows of U_k and their null flags."""
+        if self.rotation is None:
+            return self.U_n[rows], self.null[rows]
+        U_n, null = normalize(np.dot(self.buffers['U_k'].array[rows],
+                                     self.rotation))
+        return U_n, null | self.buffers['null'].array[rows]
+
+    def refresh(self):
+        self.stale = self.rotation is not None
+        if not self.stale:
+            self.U_k = self.buffers['U_k'].array
+            self.U_n = self.buffers['U_n'].array
+            self.null = self.buffers['null'].array
+        self.A = scipy.sparse.csr_matrix(
+            (self.buffers['data'].array,
+             self.buffers['indices'].array,
+             self.buffers['indptr'].array),
+            shape=(len(self.rows), len(self.cols))
+            )
+
+    def project(self, matrix):
+        return np.asarray(matrix.dot(self.V_t_k.T)).dot(self.S_k)
+
+    def neighborhood(self, query, metric='cosine', neighbors=100, exact=False):
+        """Select the neighborhood of each projected query row.
+
+        Returns flat arrays of query row, user row and weight triples. The
+        neighborhood consists of the users with the greatest distance to
+        the query, so the LSH index is probed with the negated query, which
+        is nearest to exactly those users under the cosine metric.
+
+        Cosine distances are dot products against the pre-normalized rows
+        of U_k. Passing `exact` or any other metric falls back to the
+        reference scan with cdist and a full stable sort.
+        """
+        if self.lsh is None or exact or metric != 'cosine':
+            self.materialize()
+
+        if exact or metric != 'cosine':
+            dist = scipy.spatial.distance.cdist(query, self.U_k, metric)
+            dist[np.isnan(dist)] = 0.0
+            hood = np.argsort(dist, axis=1, kind='mergesort')[:, -neighbors:]
+        elif self.lsh is None:
+            dist = cosine_distances(query, self.U_n, self.null)
+            hood = greatest(dist, neighbors)
+        else:
+            rows, cols, weights = [], [], []
+            for i, q in enumerate(query):
+                # The index hashes the stored rows, so probe with the query
+                # in their coordinates.
+                probe = q if self.inverse is None else np.dot(q, self.inverse)
+                candidates = self.lsh.query(-probe, neighbors)
+                dist = cosine_distances(q[np.newaxis, :],
+                                        *self.candidates(candidates))[0]
+                order = greatest(dist, neighbors)
+                rows.append(np.repeat(i, len(order)))
+                cols.append(candidates[order])
+                weights.append(dist[order])
+            return np.concatenate(rows), np.concatenate(cols), \
+                np.concatenate(weights)
+
+        rows = np.repeat(np.arange(hood.shape[0]), hood.shape[1])
+        cols = hood.ravel()
+        return rows, cols, dist[rows, cols]
+
+    def neighbors_many(self, matrix, batch=64, **kwargs):
+        matrix = scipy.sparse.csr_matrix(matrix)
+        hoods = []
+        for start in range(0, matrix.shape[0], batch):
+            chunk = matrix[start:start + batch]
+            rows, cols, weights = self.neighborhood(self.project(chunk),
+                                                    **kwargs)
+            hoods.extend(cols[rows == i] for i in range(chunk.shape[0]))
+        return hoods
+
+    def predict(self, vector, **kwargs):
+        return self.predict_many(vector[np.newaxis, :], **kwargs)[0]
+
+    def predict_many(self, matrix, batch=64, **kwargs):
+        matrix = scipy.sparse.csr_matrix(matrix)
+        prefs = np.empty(matrix.shape)
+        for start in range(0, matrix.shape[0], batch):
+            chunk = matrix[start:start + batch]
+            rows, cols, weights = self.neighborhood(self.project(chunk),
+                                                    **kwargs)
+            shape = chunk.shape[0], len(self.rows)
+            weights = scipy.sparse.csr_matrix((weights, (rows, cols)),
+                                              shape=shape)
+            aggregate = weights.dot(self.A).toarray()
+            chunk_prefs = aggregate ** -1
+            chunk_prefs[np.isinf(chunk_prefs)] = 0.0
+            observed = chunk.toarray()
+            prefs[start:start + batch] = np.where(observed.astype(bool),
+                                                  observed, chunk_prefs)
+        return prefs
+
+    def recommend(self, vector, **kwargs):
+        return self.recommend_many(vector[np.newaxis, :], **kwargs)[0]
+
+    def recommend_many(self, matrix, top_n=100, proximity=1.0, **kwargs):
+        prefs = self.predict_many(matrix, **kwargs)
+        prefs[prefs <= proximity] = -np.inf
+        rows = np.arange(prefs.shape[0])[:, np.newaxis]
+        top = greatest(prefs, top_n)
+        top = top[rows, np.argsort(-prefs[rows, top], axis=1)]
+        hits = np.isfinite(prefs[rows, top])
+        return [self.labels[t[h]] for t, h in zip(top, hits)]
 
     def process(self, tup):
+        if self.pending is not None:
+            (model, duration), self.pending = self.pending, None
+            self.swap(model)
+            self.metrics['rebuilds'] += 1
+            self.metrics['duration'] = duration
+            self.metrics['interval'] = time.time() - self.swapped
+            self.swapped = time.time()
+            log('[RecommendationBolt] Swapped in model of %d users after '
+                '%.1fs, rebuild took %.1fs.' % (len(self.rows),
+                                                self.metrics['interval'],
+                                                duration))
+
         if tup.stream == 'control':
             action, user = tup.values
             if action == 'connect':
                 self.connections[user] = int(time.time())
             elif action == 'disconnect':
-                del self.connections[user]
+                self.connections.pop(user, None)
 
         elif tup.stream == 'default':
             user, paths = tup.values
+            if paths:
+                self.trending.add(paths[-1])
             if user in self.connections:
                 log('[RecommendationBolt] Incoming: %s' % user)
                 vector = self.expand(paths)
                 if self.folding:
                     self.fold(user, vector)
                 recommendations = self.recommend(vector).tolist()[:10]
+                if len(recommendations) < 10:
+                    exclude = set(paths).union(recommendations)
+                    recommendations += self.trending.top(
+                        10 - len(recommendations), exclude)
                 paths = list(set(paths))[:10]
-                emit([user, paths, recommendations])
+                emit([user, paths, recommendations], need_task_ids=False)
+
+        # Page views are anchored up to here, so their trees complete only
+        # once this bolt is done with them.
+        ack(tup)
 
 
 if __name__ == '__main__':
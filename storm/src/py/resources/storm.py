@@ -26,26 +26,190 @@
     limitations under the License.
 """
 
+from multiprocessing.pool import ThreadPool
+import bisect
 import collections
+import io
 import json
 import os
+import struct
 import sys
+import threading
+import time
 import traceback
 
-
-json_encode = lambda x: json.dumps(x)
-json_decode = lambda x: json.loads(x)
+try:
+    import ujson
+    json_encode = lambda x: ujson.dumps(x, escape_forward_slashes=False)
+    json_decode = lambda x: ujson.loads(x)
+except ImportError:
+    json_encode = json.JSONEncoder(separators=(',', ':')).encode
+    json_decode = lambda x: json.loads(x)
+
+
+class JSONSerializer(object):
+    """JSON messages followed by a line reading end, Storm's default."""
+
+    def read(self, stream):
+        lines = []
+        while True:
+            line = stream.readline()
+            if line == 'end\n':
+                break
+            if not line:
+                raise EOFError('Parent process closed stdin.')
+            lines.append(line)
+        return json_decode(''.join(lines))
+
+    def frame(self, msg):
+        return json_encode(msg) + '\nend\n'
+
+
+class MsgpackSerializer(object):
+    """Msgpack messages prefixed with their 4 byte big-endian length.
+
+    Counterpart of zeit.recommend.MsgpackSerializer on the JVM side.
+    """
+
+    def __init__(self):
+        import msgpack
+        self.packb = msgpack.packb
+        self.unpackb = lambda x: msgpack.unpackb(x, encoding='utf-8')
+
+    def read(self, stream):
+        header = stream.read(4)
+        if len(header) < 4:
+            raise EOFError('Parent process closed stdin.')
+        return self.unpackb(stream.read(struct.unpack('>I', header)[0]))
+
+    def frame(self, msg):
+        data = self.packb(msg)
+        return struct.pack('>I', len(data)) + data
+
+
+class Histogram(object):
+    """Latency histogram with power of two buckets from 0.1ms to ~100s."""
+
+    BOUNDS = [0.0001 * 2 ** i for i in range(21)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th percentile.
+        rank = p * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': 1000 * self.total / max(self.count, 1),
+            'p50': 1000 * self.percentile(0.5),
+            'p99': 1000 * self.percentile(0.99),
+            'max': 1000 * self.max
+            }
+
+
+class Metrics(object):
+    """Counters and latencies of the component's hot path.
+
+    The run loops of Bolt, BasicBolt and Spout record how long they wait on
+    the parent and how long user code takes for every tuple or command.
+    Every `interval` seconds a summary of the elapsed window is logged and,
+    if `path` is set, appended to that file as a line of JSON.
+    """
+
+    def __init__(self):
+        self.name = None
+        self.component = None
+        self.interval = 0
+        self.path = None
+        self.reset(time.time())
+
+    def configure(self, conf, component):
+        self.name = component.__class__.__name__
+        self.component = component
+        self.interval = conf.get('zeit.recommend.metrics.interval', 60)
+        self.path = conf.get('zeit.recommend.metrics.file')
+
+    def reset(self, now):
+        self.started = now
+        self.counts = collections.defaultdict(int)
+        self.latency = collections.defaultdict(Histogram)
+        self.blocked = 0.0
+        self.busy = 0.0
+
+    def incr(self, key):
+        self.counts[key] += 1
+
+    def wait(self, blocked):
+        self.blocked += blocked
+
+    def record(self, key, blocked, busy):
+        self.latency[key].add(busy)
+        self.blocked += blocked
+        self.busy += busy
+
+    def report(self, now):
+        if not self.interval or now - self.started < self.interval:
+            return
+        elapsed = now - self.started
+        summary = {
+            'component': self.name,
+            'elapsed': elapsed,
+            'blocked': self.blocked / elapsed,
+            'busy': self.busy / elapsed,
+            'counts': self.counts,
+            'latency': dict((k, h.summary()) for k, h in
+                            self.latency.items())
+            }
+        if isinstance(getattr(self.component, 'metrics', None), dict):
+            summary['metrics'] = self.component.metrics
+        data = json_encode(summary)
+        log('[%s] Metrics: %s' % (self.name, data))
+        if self.path:
+            with open(self.path, 'a') as f:
+                f.write(data + '\n')
+        self.reset(now)
+
+
+# Binary streams to the parent process, independent of sys.stdin/stdout.
+STDIN = io.open(sys.stdin.fileno(), 'rb', buffering=65536, closefd=False)
+STDOUT = io.open(sys.stdout.fileno(), 'wb', buffering=65536, closefd=False)
+
+SERIALIZER = JSONSerializer()
+METRICS = Metrics()
+
+# Queue up messages for the parent until the next flush
+pending_output = []
+output_lock = threading.Lock()
+
+
+def detectSerializer():
+    # The parent picks the serializer. A JSON handshake starts with an
+    # opening brace, a length prefixed one with the high byte of its size.
+    global SERIALIZER
+    if STDIN.peek(1)[:1] not in ('{', ''):
+        SERIALIZER = MsgpackSerializer()
 
 
-# Reads lines and reconstructs newlines appropriately
 def readMsg():
-    msg = ''
-    while True:
-        line = sys.stdin.readline()[0:-1]
-        if line == 'end':
-            break
-        msg = msg + line + '\n'
-    return json_decode(msg[0:-1])
+    flush()
+    return SERIALIZER.read(STDIN)
 
 MODE = None
 ANCHOR_TUPLE = None
@@ -86,9 +250,17 @@ def readTuple():
 
 
 def sendMsgToParent(msg):
-    print json_encode(msg)
-    print 'end'
-    sys.stdout.flush()
+    data = SERIALIZER.frame(msg)
+    with output_lock:
+        pending_output.append(data)
+
+
+def flush():
+    with output_lock:
+        if pending_output:
+            STDOUT.write(''.join(pending_output))
+            STDOUT.flush()
+            del pending_output[:]
 
 
 def sync():
@@ -102,8 +274,12 @@ def sendpid(heartbeatdir):
 
 
 def emit(*args, **kwargs):
+    # The parent only replies to emits that ask for their task ids, so lists
+    # queued in pending_taskids still pair up in order with the emits that
+    # are waiting for them.
     __emit(*args, **kwargs)
-    return readTaskIds()
+    if kwargs.get('need_task_ids', True):
+        return readTaskIds()
 
 
 def emitDirect(task, *args, **kwargs):
@@ -119,7 +295,8 @@ def __emit(*args, **kwargs):
         emitSpout(*args, **kwargs)
 
 
-def emitBolt(tup, stream='default', anchors=[], directTask=None):
+def emitBolt(tup, stream='default', anchors=[], directTask=None,
+             need_task_ids=True):
     global ANCHOR_TUPLE
     if ANCHOR_TUPLE is not None:
         anchors = [ANCHOR_TUPLE]
@@ -129,11 +306,15 @@ def emitBolt(tup, stream='default', anchors=[], directTask=None):
     m['anchors'] = map(lambda a: a.id, anchors)
     if directTask is not None:
         m['task'] = directTask
+    if not need_task_ids:
+        m['need_task_ids'] = False
     m['tuple'] = tup
+    METRICS.incr('emit.%s' % stream)
     sendMsgToParent(m)
 
 
-def emitSpout(tup, stream='default', id=None, directTask=None):
+def emitSpout(tup, stream='default', id=None, directTask=None,
+              need_task_ids=True):
     m = {'command': 'emit'}
     if id is not None:
         m['id'] = id
@@ -141,15 +322,20 @@ def emitSpout(tup, stream='default', id=None, directTask=None):
         m['stream'] = stream
     if directTask is not None:
         m['task'] = directTask
+    if not need_task_ids:
+        m['need_task_ids'] = False
     m['tuple'] = tup
+    METRICS.incr('emit.%s' % stream)
     sendMsgToParent(m)
 
 
 def ack(tup):
+    METRICS.incr('ack')
     sendMsgToParent({'command': 'ack', 'id': tup.id})
 
 
 def fail(tup):
+    METRICS.incr('fail')
     sendMsgToParent({'command': 'fail', 'id': tup.id})
 
 
@@ -158,8 +344,10 @@ def log(msg):
 
 
 def initComponent():
+    detectSerializer()
     setupInfo = readMsg()
     sendpid(setupInfo['pidDir'])
+    flush()
     return [setupInfo['conf'], setupInfo['context']]
 
 
@@ -188,12 +376,22 @@ class Bolt:
         MODE = Bolt
         conf, context = initComponent()
         self.initialize(conf, context)
+        METRICS.configure(conf, self)
         try:
             while True:
+                t0 = time.time()
                 tup = readTuple()
+                t1 = time.time()
                 self.process(tup)
+                t2 = time.time()
+                flush()
+                t3 = time.time()
+                METRICS.incr('tuples.%s' % tup.stream)
+                METRICS.record('process', t1 - t0 + t3 - t2, t2 - t1)
+                METRICS.report(t3)
         except Exception, e:
             log(traceback.format_exc(e))
+            flush()
 
 
 class BasicBolt:
@@ -209,14 +407,77 @@ class BasicBolt:
         global ANCHOR_TUPLE
         conf, context = initComponent()
         self.initialize(conf, context)
+        METRICS.configure(conf, self)
         try:
             while True:
+                t0 = time.time()
                 tup = readTuple()
                 ANCHOR_TUPLE = tup
+                t1 = time.time()
                 self.process(tup)
+                t2 = time.time()
                 ack(tup)
+                flush()
+                t3 = time.time()
+                METRICS.incr('tuples.%s' % tup.stream)
+                METRICS.record('process', t1 - t0 + t3 - t2, t2 - t1)
+                METRICS.report(t3)
+        except Exception, e:
+            log(traceback.format_exc(e))
+            flush()
+
+
+class AsyncBolt:
+    """Bolt that keeps several tuples in flight at once.
+
+    Tuples are read on the main thread and handed to a pool of
+    `zeit.recommend.async.concurrency` threads running process(). A tuple is
+    acked once process() returns and failed if it raises. Emits from
+    process() must pass need_task_ids=False, since only the main thread may
+    read from the parent, and anchors=[tup] to be tied to their input.
+    """
+
+    def initialize(self, stormconf, context):
+        pass
+
+    def process(self, tuple):
+        pass
+
+    def execute(self, tup):
+        t0 = time.time()
+        try:
+            self.process(tup)
+            ack(tup)
+        except Exception, e:
+            log(traceback.format_exc(e))
+            fail(tup)
+        finally:
+            METRICS.record('process', 0.0, time.time() - t0)
+            self.slots.release()
+            flush()
+
+    def run(self):
+        global MODE
+        MODE = Bolt
+        conf, context = initComponent()
+        self.initialize(conf, context)
+        METRICS.configure(conf, self)
+        concurrency = conf.get('zeit.recommend.async.concurrency', 8)
+        self.slots = threading.BoundedSemaphore(concurrency)
+        pool = ThreadPool(concurrency)
+        try:
+            while True:
+                t0 = time.time()
+                tup = readTuple()
+                t1 = time.time()
+                METRICS.incr('tuples.%s' % tup.stream)
+                METRICS.wait(t1 - t0)
+                METRICS.report(t1)
+                self.slots.acquire()
+                pool.apply_async(self.execute, (tup,))
         except Exception, e:
             log(traceback.format_exc(e))
+            flush()
 
 
 class Spout:
@@ -237,15 +498,27 @@ class Spout:
         MODE = Spout
         conf, context = initComponent()
         self.initialize(conf, context)
+        METRICS.configure(conf, self)
         try:
             while True:
+                t0 = time.time()
                 msg = readCommand()
+                t1 = time.time()
                 if msg['command'] == 'next':
                     self.nextTuple()
                 if msg['command'] == 'ack':
                     self.ack(msg['id'])
                 if msg['command'] == 'fail':
                     self.fail(msg['id'])
+                t2 = time.time()
                 sync()
+                flush()
+                t3 = time.time()
+                key = 'nextTuple' if msg['command'] == 'next' else \
+                    msg['command']
+                METRICS.incr(msg['command'])
+                METRICS.record(key, t1 - t0 + t3 - t2, t2 - t1)
+                METRICS.report(t3)
         except Exception, e:
             log(traceback.format_exc(e))
+            flush()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+    zeit.recommend.trending
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Approximate sliding window hit counters for trending paths.
+
+    Copyright: (c) 2013 by Nicolas Drebenstedt.
+    License: BSD, see LICENSE for more details.
+"""
+
+from collections import deque
+import heapq
+import time
+
+
+class CountMinSketch(object):
+    """Fixed size frequency table that never underestimates a count."""
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.counts = [[0] * width for i in range(depth)]
+
+    def cells(self, key):
+        return [hash((i, key)) % self.width for i in range(self.depth)]
+
+    def add(self, key, count=1):
+        for row, cell in zip(self.counts, self.cells(key)):
+            row[cell] += count
+
+    def estimate(self, key):
+        return min(row[cell] for row, cell in zip(self.counts,
+                                                  self.cells(key)))
+
+    def subtract(self, other):
+        for row, other_row in zip(self.counts, other.counts):
+            for cell, count in enumerate(other_row):
+                if count:
+                    row[cell] -= count
+
+
+class TrendingCounter(object):
+    """Track the most frequent keys of the last `window` seconds.
+
+    The window is split into `buckets` sketches, the oldest of which is
+    subtracted from the running total whenever it expires. A min-heap keeps
+    the `size` keys with the highest estimates, so memory is bounded no
+    matter how many distinct keys are seen.
+    """
+
+    def __init__(self, window=3600, buckets=12, size=100, width=2048,
+                 depth=4):
+        self.span = float(window) / buckets
+        self.size = size
+        self.sketch = lambda: CountMinSketch(width, depth)
+        self.total = self.sketch()
+        self.buckets = deque([(time.time(), self.sketch())], buckets)
+        self.estimates = {}
+        self.heap = []
+        self.ranking = None
+
+    def rotate(self, now):
+        elapsed = int((now - self.buckets[-1][0]) / self.span)
+        if elapsed < 1:
+            return
+        for i in range(min(elapsed, self.buckets.maxlen)):
+            if len(self.buckets) == self.buckets.maxlen:
+                self.total.subtract(self.buckets[0][1])
+            self.buckets.append((now, self.sketch()))
+        estimates = ((k, self.total.estimate(k)) for k in self.estimates)
+        self.estimates = dict((k, e) for k, e in estimates if e)
+        self.heap = [(e, k) for k, e in self.estimates.items()]
+        heapq.heapify(self.heap)
+        self.ranking = None
+
+    def add(self, key, now=None):
+        self.rotate(time.time() if now is None else now)
+        self.buckets[-1][1].add(key)
+        self.total.add(key)
+        self.offer(key, self.total.estimate(key))
+
+    def offer(self, key, estimate):
+        # Heap entries lag behind increments of tracked keys and are only
+        # refreshed once they surface as the minimum.
+        if key in self.estimates:
+            self.estimates[key] = estimate
+        elif len(self.estimates) < self.size:
+            self.estimates[key] = estimate
+            heapq.heappush(self.heap, (estimate, key))
+        else:
+            while self.heap[0][0] != self.estimates[self.heap[0][1]]:
+                stale = self.heap[0][1]
+                heapq.heapreplace(self.heap, (self.estimates[stale], stale))
+            if estimate <= self.heap[0][0]:
+                return
+            evicted = heapq.heapreplace(self.heap, (estimate, key))[1]
+            del self.estimates[evicted]
+            self.estimates[key] = estimate
+        self.ranking = None
+
+    def top(self, n=10, exclude=()):
+        if self.ranking is None:
+            self.ranking = sorted(self.estimates, key=self.estimates.get,
+                                  reverse=True)
+        return [k for k in self.ranking if k not in exclude][:n]
@@ -10,92 +10,255 @@
     License: BSD, see LICENSE for more details.
 """
 
+from cache import LRUCache
+from collections import OrderedDict
 from datetime import date
+from datetime import timedelta
 from elasticsearch import Elasticsearch
 from elasticsearch.client import IndicesClient
-from elasticsearch.exceptions import ConnectionError
-from elasticsearch.exceptions import NotFoundError
 from elasticsearch.exceptions import TransportError
+from paths import normalize
+from paths import PathDictionary
 from storm import ack
 from storm import Bolt
 from storm import emit
 from storm import fail
 from storm import log
 import math
-import re
+import time
 
 
 class UserIndexBolt(Bolt):
+    """Keep user sessions in memory and write them behind to Elasticsearch.
+
+    Events are appended to the buffered session of their user and the
+    updated history is emitted right away. Dirty sessions are written with
+    the bulk API once `batch` tuples are pending or `interval` seconds have
+    passed, and their tuples are acked or failed with the outcome. A failed
+    session is dropped, so the replayed tuples reload it from the index.
+
+    A session holds one aggregate of count, first and last visit per path,
+    ordered by last visit. Sessions keep at most `paths` entries and, if a
+    `window` is set, only paths visited within that many seconds of the
+    latest visit. Documents of raw events are folded when loaded.
+
+    Users are written to the index of the current week and looked up in the
+    indices of the last `weeks` weeks, so histories survive week
+    boundaries. The sessions double as an LRU cache of recent readers.
+
+    Documents keep the canonical paths, the emitted histories carry their
+    ids from the shared PathDictionary.
+    """
+
     def initialize(self, conf, context):
         host = conf.get('zeit.recommend.elasticsearch.host', 'localhost')
         port = conf.get('zeit.recommend.elasticsearch.port', 9200)
         self.es = Elasticsearch(hosts=[{'host': host, 'port': port}])
-        self.match = re.compile('seite-[0-9]|komplettansicht').match
-        self.index = '%s-%s' % date.today().isocalendar()[:2]
-        ic = IndicesClient(self.es)
+        self.dictionary = PathDictionary(self.es)
+        self.batch = conf.get('zeit.recommend.user.batch', 100)
+        self.interval = conf.get('zeit.recommend.user.interval', 1.0)
+        self.paths = conf.get('zeit.recommend.user.paths', 100)
+        self.window = conf.get('zeit.recommend.user.window', 0)
+        self.weeks = conf.get('zeit.recommend.user.weeks', 4)
+        self.sessions = LRUCache(
+            conf.get('zeit.recommend.user.sessions', 10000))
+        self.metrics = self.sessions.metrics
+        self.pending = OrderedDict()
+        self.count = 0
+        self.flushed = time.time()
+        self.index = None
+        self.rollover()
 
-        try:
-            if not ic.exists(self.index):
-                ic.create(self.index)
-        except ConnectionError, e:
-            log('[UserIndexBolt] ConnectionError, index unreachable: %s' % e)
-            return
+    def indices(self):
+        today = date.today()
+        weeks = (today - timedelta(weeks=i) for i in range(self.weeks))
+        names = ['%s-%s' % week.isocalendar()[:2] for week in weeks]
+        return sorted(set(names), key=names.index)
 
-        if not ic.exists_type(index=self.index, doc_type='user'):
-            # TODO: Explicitly map out properties of nested events.
-            body = {
-                'user': {
-                    'properties': {
-                        'events': {'type': 'nested'},
-                        'rank': {'type': 'float', 'store': 'yes'}
-                        },
-                    '_boost': {
-                        'name': 'rank',
-                        'null_value': 0.1
+    def rollover(self):
+        """Switch to the index of the current week once it is ready.
+
+        The index is only switched after it was created with its mapping,
+        so a failed attempt is retried on the next flush while writes keep
+        going to the previous index.
+        """
+        index = self.indices()[0]
+        if index == self.index:
+            return
+        ic = IndicesClient(self.es)
+        body = {
+            'user': {
+                'properties': {
+                    'events': {
+                        'type': 'nested',
+                        'properties': {
+                            'path': {'type': 'string'},
+                            'count': {'type': 'integer'},
+                            'first': {'type': 'long'},
+                            'last': {'type': 'long'}
+                            }
                         },
-                    '_timestamp': {
-                        'enabled': True
-                        }
+                    'rank': {'type': 'float', 'store': 'yes'}
+                    },
+                '_boost': {
+                    'name': 'rank',
+                    'null_value': 0.1
+                    },
+                '_timestamp': {
+                    'enabled': True
                     }
                 }
-            ic.put_mapping(
-                index=self.index,
-                ignore_conflicts=True,
-                doc_type='user',
-                body=body
-                )
+            }
+
+        try:
+            if not ic.exists(index):
+                ic.create(index)
+            if not ic.exists_type(index=index, doc_type='user'):
+                ic.put_mapping(
+                    index=index,
+                    ignore_conflicts=True,
+                    doc_type='user',
+                    body=body
+                    )
+        except TransportError, e:
+            log('[UserIndexBolt] TransportError, index unreachable: %s' % e)
+            return
+        self.index = index
+
+    def session(self, user):
+        session = self.sessions.get(user)
+        if session is None:
+            session = self.lookup(user)
+            self.sessions[user] = session
+        return session
+
+    def lookup(self, user):
+        # The newest index holding the user has the most recent history.
+        docs = [{'_index': i, '_type': 'user', '_id': user}
+                for i in self.indices()]
+        result = self.es.mget(body={'docs': docs}, preference='_primary')
+        for doc in result['docs']:
+            if doc.get('found', doc.get('exists')):
+                return dict(events=self.aggregate(doc['_source']['events']),
+                            version=doc['_version'], index=doc['_index'])
+        return dict(events=OrderedDict(), version=None, index=None)
+
+    def aggregate(self, events):
+        aggregates = {}
+        for event in events:
+            first = event.get('first', event.get('timestamp'))
+            last = event.get('last', event.get('timestamp'))
+            count = event.get('count', 1)
+            if event['path'] in aggregates:
+                a = aggregates[event['path']]
+                a['count'] += count
+                a['first'] = min(a['first'], first)
+                a['last'] = max(a['last'], last)
+            else:
+                aggregates[event['path']] = dict(path=event['path'],
+                                                 count=count, first=first,
+                                                 last=last)
+        ordered = sorted(aggregates.values(), key=lambda a: a['last'])
+        return self.prune(OrderedDict((a['path'], a) for a in ordered))
+
+    def prune(self, events):
+        while len(events) > self.paths:
+            events.popitem(last=False)
+        if self.window and events:
+            latest = events[next(reversed(events))]['last']
+            cutoff = latest - self.window * 1000
+            while events[next(iter(events))]['last'] < cutoff:
+                events.popitem(last=False)
+        return events
+
+    def update(self, events, event):
+        a = events.pop(event['path'], None) or \
+            dict(path=event['path'], count=0, first=event['timestamp'])
+        a['count'] += 1
+        a['last'] = event['timestamp']
+        events[event['path']] = a
+        self.prune(events)
+
+    def flush(self):
+        self.flushed = time.time()
+        if not self.pending:
+            return
+        self.rollover()
+        pending = self.pending.items()
+        self.pending = OrderedDict()
+        self.count = 0
+
+        if self.index is None:
+            for user, (session, tuples) in pending:
+                self.sessions.pop(user)
+                for tup in tuples:
+                    fail(tup)
+            return
+
+        body = []
+        for user, (session, tuples) in pending:
+            action = {'_index': self.index, '_type': 'user', '_id': user}
+            if session['index'] != self.index:
+                # Histories found in older weeks move to the current index.
+                body.append({'create': action})
+            else:
+                action['_version'] = session['version']
+                body.append({'index': action})
+            events = session['events'].values()
+            body.append({
+                'events': events,
+                'rank': math.log10(sum(e['count'] for e in events)) / 2
+                })
+
+        try:
+            items = self.es.bulk(body)['items']
+        except TransportError, e:
+            log('[UserIndexBolt] TransportError, bulk failed: %s' % e)
+            items = [{}] * len(pending)
+
+        for (user, (session, tuples)), item in zip(pending, items):
+            result = item.values()[0] if item else {}
+            if '_version' in result and 'error' not in result:
+                session['version'] = result['_version']
+                session['index'] = self.index
+                for tup in tuples:
+                    ack(tup)
+            else:
+                self.sessions.pop(user)
+                for tup in tuples:
+                    fail(tup)
 
     def process(self, tup):
-        segments = tup.values[1].rstrip('/').rsplit('/', 1)
-        path = segments[0] if self.match(segments[-1]) else '/'.join(segments)
+        if tup.stream == '__tick':
+            ack(tup)
+            if time.time() - self.flushed >= self.interval:
+                self.flush()
+            return
 
         event = dict(
             timestamp=tup.values[0],
-            path=path
-            )
-
-        kwargs = dict(
-            id=tup.values[2]
+            path=normalize(tup.values[1])
             )
+        user = tup.values[2]
 
         try:
-            # TODO: Retrieve users from all indicies.
-            events = self.es.get(self.index, kwargs['id'], 'user',
-                                 preference='_primary')
-            kwargs['version'] = events['_version']
-            body = {'events': events['_source']['events'] + [event]}
-        except NotFoundError:
-            kwargs['op_type'] = 'create'
-            body = {'events': [event]}
-
-        try:
-            body['rank'] = math.log10(len(body['events'])) / 2
-            self.es.index(self.index, 'user', body, **kwargs)
-            paths = list(event['path'] for event in body['events'])
-            emit([kwargs['id'], paths])
-            ack(tup)
-        except TransportError:
+            session = self.session(user)
+            self.dictionary.encode_many(session['events'].keys() +
+                                        [event['path']])
+        except TransportError, e:
+            log('[UserIndexBolt] TransportError, user unreachable: %s' % e)
             fail(tup)
+            return
+
+        self.update(session['events'], event)
+        ids = self.dictionary.encode_many(session['events'])
+        self.pending.setdefault(user, (session, []))[1].append(tup)
+        self.count += 1
+        emit([user, ids], anchors=[tup], need_task_ids=False)
+
+        if self.count >= self.batch or \
+                time.time() - self.flushed >= self.interval:
+            self.flush()
 
 
 if __name__ == '__main__':
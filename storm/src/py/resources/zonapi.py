@@ -10,69 +10,159 @@
     License: BSD, see LICENSE for more details.
 """
 
+from collections import OrderedDict
 from datetime import datetime
 from storm import emit
 from storm import log
 from storm import Spout
-from time import sleep
 from urllib import urlencode
 from urllib import urlopen
 import json
+import os
+import Queue
+import threading
+import time
+
+
+def quote(value):
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
 
 
 class ZonAPISpout(Spout):
+    """Follow new articles and backfill the archive in release order.
+
+    Two background threads page through Solr, `rows` documents at a time,
+    sorted by release date and uuid, each page starting right after the
+    last document of the previous one. The `newest` cursor starts at the
+    time of the first run and polls for new articles every `interval`
+    seconds. The `backfill` cursor walks the archive from `since` up to
+    that point and then stops. Documents are queued per cursor and
+    nextTuple, which never waits for Solr, always prefers new articles.
+
+    For each cursor, the position of the oldest document not yet acked or
+    failed for good is written to `checkpoint`, so a restarted spout
+    resumes both where they left off.
+    """
+
     def initialize(self, conf, context):
         host = conf.get('zeit.recommend.zonapi.host', 'localhost')
         port = conf.get('zeit.recommend.zonapi.port', 8983)
         self.url = 'http://%s:%s/solr/select' % (host, port)
-        self.newest = datetime.now()
-        self.start = 0
+        self.rows = conf.get('zeit.recommend.zonapi.rows', 100)
+        self.interval = conf.get('zeit.recommend.zonapi.interval', 10.0)
+        self.checkpoint = conf.get('zeit.recommend.zonapi.checkpoint')
+        since = conf.get('zeit.recommend.zonapi.since',
+                         '1970-01-01T00:00:00Z')
+        now = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), ''
+        self.marks = dict(newest=now, backfill=(since, ''), until=now)
+        self.marks.update(self.load())
+        self.saved = time.time()
+        self.queues = dict((name, Queue.Queue(maxsize=2 * self.rows))
+                           for name in ('newest', 'backfill'))
+        self.inflight = dict((name, OrderedDict())
+                             for name in ('newest', 'backfill'))
+        self.done = set()
         self.buffer = {}
 
+        for name in ('newest', 'backfill'):
+            thread = threading.Thread(target=self.fetch, args=(name,))
+            thread.daemon = True
+            thread.start()
+
+    def load(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            marks = json.load(open(self.checkpoint))
+            log('[ZonAPISpout] Resuming after %s.' % marks)
+            return dict((k, tuple(v)) for k, v in marks.items())
+        return {}
+
+    def save(self):
+        self.saved = time.time()
+        if not self.checkpoint:
+            return
+        directory = os.path.dirname(self.checkpoint)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        partial = self.checkpoint + '.partial'
+        json.dump(self.marks, open(partial, 'w'))
+        os.rename(partial, self.checkpoint)
+
+    def settle(self, cnt_id):
+        # Advance a mark over the completed prefix of its emitted documents.
+        self.done.add(cnt_id)
+        for name, inflight in self.inflight.items():
+            while inflight and next(iter(inflight)) in self.done:
+                uuid, self.marks[name] = inflight.popitem(last=False)
+                self.done.discard(uuid)
+        if time.time() - self.saved >= 1.0:
+            self.save()
+
     def ack(self, cnt_id):
         tup, retries = self.buffer[cnt_id]
         del self.buffer[cnt_id]
+        self.settle(cnt_id)
         log('[ZonAPISpout] Acknowledging content id-%s.' % cnt_id)
 
     def fail(self, cnt_id):
         tup, retries = self.buffer[cnt_id]
         if retries >= 5:
             del self.buffer[cnt_id]
+            self.settle(cnt_id)
             log('[ZonAPISpout] Message %s failed for good.' % cnt_id)
         else:
             self.buffer[cnt_id] = (tup, retries + 1)
-            emit(tup, id=cnt_id)
+            emit(tup, id=cnt_id, need_task_ids=False)
 
-    def get_docs(self):
-        date_range = '%s:00Z TO NOW' % self.newest.isoformat()[:-3]
+    def get_docs(self, cursor):
+        release_date, uuid = map(quote, cursor)
         params = dict(
             wt='json',
-            q='release_date:[%s]' % date_range,
+            q='release_date:{%s TO *} OR (release_date:%s AND uuid:{%s TO *})'
+              % (release_date, release_date, uuid),
             fl='uuid,href,release_date,title',
-            sort='release_date asc',
-            rows='1'
+            sort='release_date asc,uuid asc',
+            rows=self.rows
             )
         raw = urlopen(self.url, urlencode(params))
-        docs = json.loads(raw.read())['response']['docs']
-        if docs:
-            args = docs[0]['release_date'], '%Y-%m-%dT%H:%M:%SZ'
-            self.newest = datetime.strptime(*args)
-        else:
-            params['q'] = '*:*'
-            params['start'] = self.start
-            params['sort'] = 'release_date desc'
-            self.start += 1
-            raw = urlopen(self.url, urlencode(params))
-            docs = json.loads(raw.read())['response']['docs']
-        return docs
+        return json.loads(raw.read())['response']['docs']
+
+    def fetch(self, name):
+        cursor = self.marks[name]
+        until = self.marks['until'] if name == 'backfill' else None
+        while until is None or cursor < until:
+            try:
+                docs = self.get_docs(cursor)
+            except (IOError, ValueError), e:
+                log('[ZonAPISpout] Solr request failed: %s' % e)
+                time.sleep(self.interval)
+                continue
+            for doc in docs:
+                cursor = doc['release_date'], doc['uuid']
+                if until is not None and cursor > until:
+                    break
+                self.queues[name].put(doc)
+            if len(docs) < self.rows:
+                if until is not None:
+                    break
+                time.sleep(self.interval)
+        log('[ZonAPISpout] Backfill reached %s.' % (until,))
 
     def nextTuple(self):
-        docs = self.get_docs()
-        uuid = docs[0]['uuid']
-        tup = [docs[0]['href'][18:]]
+        for name in ('newest', 'backfill'):
+            try:
+                doc = self.queues[name].get_nowait()
+                break
+            except Queue.Empty:
+                continue
+        else:
+            return
+        uuid = doc['uuid']
+        args = doc['release_date'], '%Y-%m-%dT%H:%M:%SZ'
+        ts = int(datetime.strptime(*args).strftime('%s000'))
+        tup = [doc['href'][18:], ts]
         self.buffer[uuid] = (tup, 0)
-        emit(tup, id=uuid)
-        sleep(1.0)
+        self.inflight[name][uuid] = doc['release_date'], uuid
+        emit(tup, id=uuid, need_task_ids=False)
 
 if __name__ == '__main__':
     ZonAPISpout().run()